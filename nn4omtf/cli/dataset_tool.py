@@ -7,8 +7,15 @@
 """
 
 import nn4omtf
+import multiprocessing
 import os
-from nn4omtf import OMTFDataset
+import time
+import traceback
+from nn4omtf import OMTFDataset, OMTFDatasetCache, OMTFSourceCatalog
+from nn4omtf.dataset_cache import remove_path
+from nn4omtf.dataset_catalog import expand_sources
+from nn4omtf.dataset_files import load_dataset_meta
+from nn4omtf.const_files import FILE_FORMATS
 from .tool import OMTFTool
 from .dataset_tool_config import ACTION, parser_config
 from .utils import create_parser
@@ -21,6 +28,8 @@ class OMTFDatasetTool(OMTFTool):
         handlers = [
             (ACTION.SHOW, OMTFDatasetTool._show),
             (ACTION.CREATE, OMTFDatasetTool._create),
+            (ACTION.APPEND, OMTFDatasetTool._append),
+            (ACTION.SCAN_THRESHOLD, OMTFDatasetTool._scan_threshold),
             (ACTION.CONVERT, OMTFDatasetTool._convert),
         ]
         super().__init__(parser_config, "OMTF dataset tool", handlers)
@@ -36,13 +45,161 @@ class OMTFDatasetTool(OMTFTool):
         if FLAGS.transform is not None:
             transform = tuple(FLAGS.transform)
 
-        ds = OMTFDataset(FLAGS.files, FLAGS.train, FLAGS.valid, FLAGS.test, 
-                transform=transform, treshold=FLAGS.treshold)
-        ds.generate()
+        files = expand_sources(FLAGS.files)
+        catalog = None
+        if FLAGS.dry_run or FLAGS.pt_codes is not None or \
+                FLAGS.sign is not None:
+            catalog = OMTFSourceCatalog(files)
+            files = catalog.select(pt_codes=FLAGS.pt_codes, sign=FLAGS.sign)
+            print('Source files selected: %d' % len(files))
+
+        prefs = [FLAGS.file_pref]
+        kfolds = [None]
+        if FLAGS.kfold is not None:
+            prefs = ['%s-fold%d' % (FLAGS.file_pref, k) 
+                    for k in range(FLAGS.kfold)]
+            kfolds = [(k, FLAGS.kfold) for k in range(FLAGS.kfold)]
+        ds_paths = [os.path.join(path, p + '-dataset') for p in prefs]
+        ds_stats = [os.path.join(path, p + '-stats') for p in prefs]
+        outputs = []
+        for ds_path, ds_stat in zip(ds_paths, ds_stats):
+            if not FLAGS.stream and FLAGS.shard is None:
+                ds_path = ds_path + '.npz'
+            outputs += [ds_path, ds_stat + '.npz']
+
+        if FLAGS.dry_run:
+            ds = OMTFDataset(files, FLAGS.train, FLAGS.valid, FLAGS.test, 
+                    transform=transform, treshold=FLAGS.treshold, 
+                    kfold=kfolds[0], hits_full=FLAGS.hits_full)
+            ds.dry_run(catalog)
+            return
+
+        cache = None
+        if FLAGS.cache is not None:
+            if FLAGS.seed is None:
+                print('Random seed, dataset will not be cached!')
+            else:
+                cache = OMTFDatasetCache(FLAGS.cache, 
+                        max_size=FLAGS.cache_size * 2**20)
+                params = {
+                    'train': FLAGS.train, 'valid': FLAGS.valid, 
+                    'test': FLAGS.test, 'treshold': FLAGS.treshold,
+                    'transform': transform, 'seed': FLAGS.seed,
+                    'stream': FLAGS.stream, 'shard': FLAGS.shard,
+                    'compression': FLAGS.compression}
+                if FLAGS.kfold is not None:
+                    params['kfold'] = FLAGS.kfold
+                if FLAGS.hits_full:
+                    params['hits_full'] = True
+                key = cache.get_key(files, **params)
+                if cache.fetch(key, outputs):
+                    print('Dataset taken from cache: %s' % key)
+                    return
+
+        # Old outputs may be hard-linked with cache entries,
+        # so they can't be overwritten in place
+        for p in outputs:
+            remove_path(p)
+
+        ds = OMTFDataset(files, FLAGS.train, FLAGS.valid, FLAGS.test, 
+                transform=transform, treshold=FLAGS.treshold, 
+                block_size=FLAGS.block, seed=FLAGS.seed, kfold=kfolds[0],
+                hits_full=FLAGS.hits_full)
+        # All folds are generated in single pass over source files
+        splits = [{'kfold': k} for k in kfolds[1:]]
+        if FLAGS.stream:
+            for spec, ds_path in zip(splits, ds_paths[1:]):
+                spec['outdir'] = ds_path
+            datasets = ds.generate(outdir=ds_paths[0], jobs=FLAGS.jobs, 
+                    splits=splits)
+        else:
+            datasets = ds.generate(jobs=FLAGS.jobs, splits=splits)
+        for ds, ds_path, ds_stat in zip([ds] + datasets, ds_paths, ds_stats):
+            if FLAGS.stream or FLAGS.shard is not None:
+                ds.save_dataset(ds_path, fmt=FILE_FORMATS.NPY, 
+                        shard_size=FLAGS.shard)
+            else:
+                ds.save_dataset(ds_path, compression=FLAGS.compression)
+            ds.save_stats(ds_stat)
+        # Profiler is shared by all datasets generated in single pass
+        ds.profiler.print_report()
+        if FLAGS.profile is not None:
+            ds.save_profile(FLAGS.profile)
+        if cache is not None:
+            cache.store(key, outputs, params)
+
+
+    def _append(FLAGS):
+        """
+        Append new files to existing dataset.
+        Dataset is saved in the same format it was created.
+        In stream mode dataset directory is generated next to old one
+        and replaces it when it's complete.
+        """
+        path = '.'
+        if FLAGS.outdir is not None:
+            path = FLAGS.outdir
         ds_path = os.path.join(path, FLAGS.file_pref + '-dataset')
         ds_stat = os.path.join(path, FLAGS.file_pref + '-stats')
-        ds.save_dataset(ds_path)
+        shard_size = None
+        single_file = not os.path.isdir(ds_path)
+        outdir = None
+        if single_file:
+            ds_path = ds_path + '.npz'
+        else:
+            shard_size = load_dataset_meta(ds_path).get('shard_size')
+            if FLAGS.stream:
+                outdir = ds_path + '.append'
+                remove_path(outdir)
+
+        ds = OMTFDataset.load(ds_path, ds_stat + '.npz', 
+                block_size=FLAGS.block, stream=FLAGS.stream)
+        ds.append(FLAGS.files, jobs=FLAGS.jobs, outdir=outdir)
+        if outdir is not None:
+            ds.save_dataset(outdir, fmt=FILE_FORMATS.NPY, 
+                    shard_size=shard_size)
+        # Outputs may be hard-linked with cache entries
+        for p in [ds_path, ds_stat + '.npz']:
+            remove_path(p)
+        if outdir is not None:
+            os.rename(outdir, ds_path)
+        elif single_file:
+            ds.save_dataset(ds_path, compression=FLAGS.compression)
+        else:
+            ds.save_dataset(ds_path, fmt=FILE_FORMATS.NPY, 
+                    shard_size=shard_size)
         ds.save_stats(ds_stat)
+        ds.profiler.print_report()
+
+
+    def _scan_threshold(FLAGS):
+        """
+        Show what `create` would produce for each of given thresholds.
+        """
+        ds = OMTFDataset(expand_sources(FLAGS.files), FLAGS.train, 
+                FLAGS.valid, FLAGS.test)
+        results = ds.scan_tresholds(FLAGS.tresholds, jobs=FLAGS.jobs)
+        print('=' * 10 + ' THRESHOLD SCAN')
+        print("%10s %10s %10s %10s %10s %10s %10s %10s" % ('treshold', 
+            'good', 'null', 'scaled', 'train', 'valid', 'test', 'max train'))
+        for res in results:
+            good_n = sum([f[1] for f in res['files']])
+            null_n = sum([f[2] for f in res['files']])
+            scaled = len([f for f in res['files'] if min(f[3], f[4]) < 1])
+            print("%10.1f %10d %10d %10d %10d %10d %10d %10d" % (
+                res['treshold'], good_n, null_n, scaled, 
+                *res['phase_n'], res['max_phase_n'][0]))
+        if not FLAGS.verbose:
+            return
+        for res in results:
+            print('=' * 10 + ' TRESHOLD %f' % res['treshold'])
+            print("Max phases sizes without scaling: %d, %d, %d" % 
+                    tuple(res['max_phase_n']))
+            print("%8s %5s %10s %10s %8s %8s" % ('pt code', 'sign', 'good', 
+                'null', 'good_f', 'null_f'))
+            for (code, sign), good_n, null_n, good_f, null_f in res['files']:
+                print("%8d %5s %10d %10d %8.3f %8.3f" % (code, sign, good_n, 
+                    null_n, good_f, null_f))
 
 
     def _show(FLAGS):
@@ -52,39 +209,126 @@ class OMTFDatasetTool(OMTFTool):
     def _convert(FLAGS):
         """
         Convert list of ROOT dataset files into Numpy dataset.
+        Each source directory is converted independently, so conversion
+        can be run in a pool of `FLAGS.jobs` processes.
+        Directories which are unchanged since last conversion (according to
+        manifest in destination directory) are skipped unless `FLAGS.force`.
         """
         flist = FLAGS.data
-        name = FLAGS.dest
+        dest = FLAGS.dest
 
         print("Importing ROOT's stuff...")
         # I know... Importing here is not beautiful but...
         nn4omtf.import_root_utils()
+        ru = nn4omtf.root_utils
         print("Creating directory: " + dest)
         os.makedirs(dest, exist_ok=True)
+
+        manifest = ru.load_manifest(dest, ru.CONVERTER_VERSION)
+        if not FLAGS.force:
+            skipped = [f for f in flist if _is_converted(manifest, f, dest, 
+                FLAGS.hash, FLAGS.format)]
+            for f in skipped:
+                print("Up to date, skipping: " + f)
+            flist = [f for f in flist if f not in skipped]
+            # Stamps of sources found unchanged by hash are refreshed
+            if skipped:
+                ru.save_manifest(dest, manifest)
         
         total = len(flist)
-        cnt = 1
-        time_start = time.time()
-        time_last = time_start
-        print("Starting conversion of {} files".format(total))
+        if total == 0:
+            print("Nothing to convert!")
+            return
+        jobs = max(1, min(FLAGS.jobs, total))
+        print("Starting conversion of {} files using {} jobs".format(total, jobs))
         for f in flist:
             print("> " + f)
 
-        for f in flist:
-            print("Converting {} of {}: {}".format(cnt, total, f))
-            data = nn4omtf.root_utils.load_root_dict(f)
-            name = data[1]['name']
-            sign = data[1]['sign']
-            pt_code = data[1]['val']
-            x = nn4omtf.root_utils.root_to_numpy(name, sign, pt_code, data[0])
-            path = os.path.join(dest, "{}_{}_{}.npz".format(name, sign, pt_code))
-            print("Saving converted data as " + path)
-            nn4omtf.utils.save_dict_as_npz(path, **x)
-            now = time.time()
-            print("Done in %.2f sec." % (now-time_last))
-            print("Elapsed from start: {}' {}''".format(int((now - time_start) // 60), int(now - time_start) % 60))
-            cnt += 1
-            time_last = now
+        time_start = time.time()
+        tasks = [(f, dest, FLAGS.chunk, FLAGS.hash, FLAGS.format) 
+                for f in flist]
+        pool = None
+        if jobs == 1:
+            results = map(_convert_worker, tasks)
+        else:
+            pool = multiprocessing.Pool(processes=jobs)
+            results = pool.imap_unordered(_convert_worker, tasks)
 
+        cnt = 0
+        failed = []
+        ev_n = 0
+        bytes_in = 0
+        try:
+            for f, res, err in results:
+                cnt += 1
+                now = time.time()
+                if err is not None:
+                    print("[{}/{}] FAILED {}:\n{}".format(cnt, total, f, err))
+                    failed.append(f)
+                else:
+                    print("[{}/{}] {} -> {}, {} events in {:.2f} sec.".format(
+                        cnt, total, f, res['path'], res['ev_n'], res['time']))
+                    ev_n += res['ev_n']
+                    bytes_in += res['bytes_in']
+                    ru.update_manifest(manifest, _manifest_key(f), res['source'],
+                            res['path'], dest)
+                    ru.save_manifest(dest, manifest)
+                print("Elapsed from start: {}' {}''".format(
+                    int((now - time_start) // 60), int(now - time_start) % 60))
+        except BaseException:
+            # Don't leave workers running on error or Ctrl-C
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            raise
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        elapsed = max(time.time() - time_start, 1e-9)
         print("Conversion finished!")
+        print("Converted: {}, failed: {}".format(total - len(failed), len(failed)))
+        for f in failed:
+            print("! " + f)
+        print("Events: {}, time: {:.2f} sec.".format(ev_n, elapsed))
+        print("Throughput: {:.1f} events/s, {:.2f} MB/s".format(
+            ev_n / elapsed, bytes_in / elapsed / 2**20))
+
+
+def _manifest_key(path):
+    return os.path.basename(os.path.normpath(path))
+
 
+def _is_converted(manifest, path, dest, with_hash, fmt):
+    """
+    Check in manifest whether ROOT directory was already converted.
+    """
+    ru = nn4omtf.root_utils
+    try:
+        out = ru.get_output_path(path, dest, fmt)
+    except ValueError:
+        # Let converter report invalid directory
+        return False
+    src = os.path.join(path, ru.ROOT_FILE_NAME)
+    return ru.is_up_to_date(manifest, _manifest_key(path), src, out, 
+            with_hash=with_hash)
+
+
+def _convert_worker(task):
+    """
+    Convert single ROOT directory.
+    Errors are returned instead of raised to not break other conversions.
+    Args:
+        task: (source directory, destination directory, chunk size, 
+            calculate source hash, output format)
+    Returns:
+        (source directory, conversion summary, formatted error or None)
+    """
+    path, dest, chunk_size, with_hash, fmt = task
+    try:
+        nn4omtf.import_root_utils()
+        res = nn4omtf.root_utils.convert_root_dir(path, dest, 
+                chunk_size=chunk_size, with_hash=with_hash, fmt=fmt)
+        return path, res, None
+    except Exception:
+        return path, None, traceback.format_exc()
@@ -6,11 +6,15 @@
     OMTF dataset command line tool configuration
 """
 
+from nn4omtf.const_files import FILE_FORMATS, COMPRESSION
+
 
 class ACTION:
     SHOW = 'show'
     CONVERT = 'root2np'
     CREATE = 'create'
+    APPEND = 'append'
+    SCAN_THRESHOLD = 'scan-threshold'
 
 
 parser_config = {
@@ -18,7 +22,19 @@ parser_config = {
     'root2np': {
         'help': "Convert ROOT datasets to Numpy arrays. ROOT environment requred!",
         'opts': [
-            ("verbose", {'action': "store_true"})
+            ("verbose", {'action': "store_true"}),
+            ("jobs", {'type': int, 'metavar': 'N', 'default': 1,
+                'help': "Number of parallel conversion processes"}),
+            ("chunk", {'type': int, 'metavar': 'N',
+                'help': "Convert files in chunks of N events to limit memory usage"}),
+            ("force", {'action': "store_true",
+                'help': "Convert all directories, even if unchanged"}),
+            ("hash", {'action': "store_true",
+                'help': "Store and compare content hashes of source files"}),
+            ("format", {'choices': [FILE_FORMATS.NPZ, FILE_FORMATS.NPY],
+                'default': FILE_FORMATS.NPZ,
+                'help': "Output format: compressed `*.npz` file or directory "
+                    "of memory-mappable `*.npy` files"})
         ],
         'pos': [
             ("dest", {'help': "Destination directory"}),
@@ -27,18 +43,96 @@ parser_config = {
     },
 
     'create': {
-        'help': "Create dataset from `*.npz` files",
+        'help': "Create dataset from converted `*.npz` files or `*.npy` directories",
         'opts': [
             ('outdir', {'help': "Output directory"}),
             ('train', {'type': int, 'metavar': 'N', 'default': 10000}),
             ('valid', {'type': int, 'metavar': 'N', 'default': 5000}),
             ('test', {'type': int, 'metavar': 'N', 'default': 5000}),
             ('treshold', {'type': float, 'metavar': 'T', 'default': 5400}),
-            ('transform', {'type': int, 'metavar': ('NULL VALUE', 'SHIFT'), 'nargs': 2})
+            ('transform', {'type': int, 'metavar': ('NULL VALUE', 'SHIFT'), 'nargs': 2}),
+            ('stream', {'action': "store_true",
+                'help': "Write examples directly into memory-mapped `*.npy` "
+                    "dataset directory, dataset doesn't have to fit in memory"}),
+            ('block', {'type': int, 'metavar': 'N', 'default': 2**20,
+                'help': "Number of examples shuffled at once in stream mode"}),
+            ('jobs', {'type': int, 'metavar': 'N', 'default': 1,
+                'help': "Number of processes reading source files"}),
+            ('seed', {'type': int, 'metavar': 'S',
+                'help': "Shuffle seed, random if not given (saved in stats)"}),
+            ('shard', {'type': int, 'metavar': 'N',
+                'help': "Store dataset as directory of shards of N examples"}),
+            ('hits_full', {'action': "store_true",
+                'help': "Store also full HITS tensors in sparse form"}),
+            ('kfold', {'type': int, 'metavar': 'K',
+                'help': "Create K datasets for K-fold cross-validation "
+                    "(`<file_pref>-fold<k>-*` files) in single pass"}),
+            ('compression', {'choices': [COMPRESSION.NONE, COMPRESSION.FAST, 
+                COMPRESSION.MAX], 'default': COMPRESSION.NONE,
+                'help': "Dataset `*.npz` file compression, only uncompressed "
+                    "files can be memory-mapped. Use `max` for archives"}),
+            ('profile', {'metavar': 'JSON',
+                'help': "Save time and memory used by generation stages "
+                    "(also stored in stats) as JSON file"}),
+            ('cache', {'metavar': 'DIR',
+                'help': "Cache directory, datasets generated with same sources, "
+                    "parameters and seed are taken from cache"}),
+            ('cache_size', {'type': int, 'metavar': 'MB', 'default': 10240,
+                'help': "Cache size limit, least recently used datasets "
+                    "are removed"}),
+            ('pt_codes', {'type': int, 'metavar': ('MIN', 'MAX'), 'nargs': 2,
+                'help': "Take only source files of pt codes in range"}),
+            ('sign', {'choices': ['p', 'm'],
+                'help': "Take only source files of given muon charge sign"}),
+            ('dry_run', {'action': "store_true",
+                'help': "Show partition, files without enough events and "
+                    "expected dataset size, without reading HITS"})
         ],
         'pos': [
             ('file_pref', {'help': "Output file prefix"}),
-            ('files', {'help': "Source files", 'nargs': '*'})
+            ('files', {'help': "Source files, `*.npy` directories or "
+                "directories containing them", 'nargs': '*'})
+        ]
+    },
+
+    'append': {
+        'help': "Append new source files to dataset created by `create`",
+        'opts': [
+            ('outdir', {'help': "Dataset directory"}),
+            ('jobs', {'type': int, 'metavar': 'N', 'default': 1,
+                'help': "Number of processes reading source files"}),
+            ('stream', {'action': "store_true",
+                'help': "Don't load existing dataset, its examples are "
+                    "read file by file. Dataset directory is written "
+                    "through memory-mapped `*.npy` files"}),
+            ('block', {'type': int, 'metavar': 'N', 'default': 2**20,
+                'help': "Number of examples shuffled at once in stream mode"}),
+            ('compression', {'choices': [COMPRESSION.NONE, COMPRESSION.FAST, 
+                COMPRESSION.MAX], 'default': COMPRESSION.NONE,
+                'help': "Dataset `*.npz` file compression"})
+        ],
+        'pos': [
+            ('file_pref', {'help': "Dataset file prefix"}),
+            ('files', {'help': "New source files", 'nargs': '+'})
+        ]
+    },
+
+    'scan-threshold': {
+        'help': "Show numbers of good and null events and phases sizes "
+            "`create` would give for many thresholds, without generation",
+        'opts': [
+            ('train', {'type': int, 'metavar': 'N', 'default': 10000}),
+            ('valid', {'type': int, 'metavar': 'N', 'default': 5000}),
+            ('test', {'type': int, 'metavar': 'N', 'default': 5000}),
+            ('tresholds', {'type': float, 'metavar': 'T', 'nargs': '+',
+                'required': True, 'help': "Thresholds to check"}),
+            ('jobs', {'type': int, 'metavar': 'N', 'default': 1,
+                'help': "Number of processes reading source files"}),
+            ('verbose', {'action': "store_true",
+                'help': "Show numbers of events in each file"})
+        ],
+        'pos': [
+            ('files', {'help': "Source files", 'nargs': '+'})
         ]
     },
 
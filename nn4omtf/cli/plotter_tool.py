@@ -27,8 +27,7 @@ class OMTFPlotterTool(OMTFTool):
 
 
     def _show(opts):
-        with OMTFPlotter(opts.path) as p:
-            ls = p.get_plottables()
+        ls = OMTFPlotter.get_file_plottables(opts.path)
         if not ls:
             print("No plottable elements!")
         else:
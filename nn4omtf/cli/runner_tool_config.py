@@ -7,6 +7,7 @@
 """
 
 from nn4omtf.model_config import model_hparams_keys, model_config_keys
+from nn4omtf.const_files import COMPRESSION
 
 class ACTION:
     MODEL = 'model'
@@ -54,7 +55,8 @@ parser_config = {
             ('time_limit', {'metavar': 'H+:MM:SS', 'help': 'Training time limit'}),
             ('update_config', {'action': 'store_true', 'help': 'Update model config with provided options'}),
             ('validation_ival', {'type': int, 'help': 'Number of batches processed between validation'}),
-            ('train_summary_ival', {'type': int, 'help': 'Number of batches processed between summary collection'})
+            ('train_summary_ival', {'type': int, 'help': 'Number of batches processed between summary collection'}),
+            ('stream', {'action': 'store_true', 'help': 'Stream datasets from disk, they don`t have to fit in memory'})
         ],
         'pos': [
             ('model_dir', {'help': "Directory of model to be trained"}),
@@ -66,7 +68,10 @@ parser_config = {
         'opts': model_config_opts + model_hparams_opts + [
             ('update_config', {'action': 'store_true', 'help': 'Update model config with provided options'}),
             ('note', {'help': 'Note to store along with results', 'default': ''}),
-            ('suffix', {'help': 'Suffix to append to results file name', 'default': ''})
+            ('suffix', {'help': 'Suffix to append to results file name', 'default': ''}),
+            ('compression', {'choices': [COMPRESSION.NONE, COMPRESSION.FAST, COMPRESSION.MAX], 
+                'default': COMPRESSION.FAST, 'help': 'Results files compression'}),
+            ('stream', {'action': 'store_true', 'help': 'Stream TEST dataset from disk'})
         ],
         'pos': [
             ('model_dir', {'help': "Directory of model to be tested"}),
@@ -9,6 +9,7 @@
 
 class NPZ_DATASET:
     HITS_REDUCED = 'hits_reduced'
+    HITS_FULL = 'hits_full'
     PROD = 'prod'
     OMTF = 'omtf'
 
@@ -16,6 +17,27 @@ class NPZ_DATASET:
     SIGN = "sign"
 
 
+class NPZ_INDEX:
+    """
+    Arrays of source file index, see `nn4omtf.dataset_index`.
+    """
+    EV_N = 'ev_n'
+    # Number of HITS values in single event
+    HITS_SIZE = 'hits_size'
+    # Sum of HITS in each event, mean is `SUMS / HITS_SIZE`
+    SUMS = 'sums'
+    # Events sorted by mean, stable
+    ORDER = 'order'
+    # Number of NULL HITS and sum of other HITS in each event
+    NULL_N = 'null_n'
+    VALID_SUMS = 'valid_sums'
+    # Distinct HITS values and their counts
+    VALS = 'vals'
+    VALS_N = 'vals_n'
+    PT_CODE = 'pt_code'
+    SIGN = 'sign'
+
+
 class DATASET_TYPES:
     TRAIN = 'TRAIN'
     VALID = 'VALID'
@@ -57,7 +79,60 @@ class DATASET_FIELDS:
     OMTF_PT = 'OMTF_PT'
     OMTF_SIGN = 'OMTF_SIGN'
     OMTF_QUALITY = 'OMTF_QUALITY'
-    
+
+    # Optional full HITS tensors stored in sparse form,
+    # see `nn4omtf.dataset_files.sparse_hits_full`
+    HITS_FULL_POS = 'HITS_FULL_POS'
+    HITS_FULL_VAL = 'HITS_FULL_VAL'
+
+
+# Storage types of dataset fields.
+# HITS are small integers, data is converted to float32 
+# only when it's fed into network.
+DATASET_DTYPES = {
+    DATASET_FIELDS.HITS: 'int16',
+    DATASET_FIELDS.PT_VAL: 'float32',
+    DATASET_FIELDS.SIGN: 'int8',
+    DATASET_FIELDS.IS_NULL: 'bool',
+    DATASET_FIELDS.PT_CODE: 'int8',
+    DATASET_FIELDS.OMTF_PT: 'float32',
+    DATASET_FIELDS.OMTF_SIGN: 'int8',
+    DATASET_FIELDS.OMTF_QUALITY: 'int8',
+    DATASET_FIELDS.HITS_FULL_POS: 'uint8',
+    DATASET_FIELDS.HITS_FULL_VAL: 'int16',
+}
+
+# Shape of full HITS tensor of single event
+HITS_FULL_SHAPE = [18, 14]
+# Values of padding in sparse full HITS fields
+HITS_FULL_PADDING = {
+    DATASET_FIELDS.HITS_FULL_POS: 255,
+    DATASET_FIELDS.HITS_FULL_VAL: 0,
+}
+
+
+class PROFILE_STAGES:
+    """
+    Stages of dataset generation measured by profiler.
+    """
+    # Reading source arrays (memory-mapped arrays are read on first use)
+    LOAD = 'load'
+    # HITS mean per event (source file index) and good/null masks
+    MEAN_MASK = 'mean_mask'
+    TRANSFORM = 'transform'
+    HISTOGRAM = 'histogram'
+    # Conversion of full HITS into sparse form
+    SPARSE = 'sparse'
+    # Copying selected examples into dataset arrays
+    SLICING = 'slicing'
+    SHUFFLE = 'shuffle'
+    # Checksums of shuffled datasets
+    VALIDATION = 'validation'
+    # Compression and writing of dataset and statistics files
+    WRITE = 'write'
+    # Whole generation, wall time
+    GENERATE = 'generate'
+
 
 class DSET_STAT_FIELDS: 
     TRAIN_EXAMPLES_ORDERING = 'TRAIN_EXAMPLES_ORDERING'
@@ -72,6 +147,16 @@ class DSET_STAT_FIELDS:
     HISTS_BINS = 'HISTS_BINS'
     TRANSFORM = 'TRANSFORM'
     TRESHOLD = 'TRESHOLD'
+    SEED = 'SEED'
+    # Dataset generation parameters, required to append new files
+    FILES = 'FILES'
+    PHASE_N = 'PHASE_N'
+    # Number of (good, null) events available in each file
+    EVENTS = 'EVENTS'
+    # (k, K) - fold of K-fold cross-validation dataset, None if not used
+    KFOLD = 'KFOLD'
+    # Resources used by generation stages, see `PROFILE_STAGES`
+    PROFILE = 'PROFILE'
 
 
 class NPZ_FIELDS:
@@ -81,13 +166,17 @@ class NPZ_FIELDS:
     PROD_IDX_SIGN = 3
     OMTF_IDX_PT = 1
     OMTF_IDX_SIGN = 0
+    OMTF_IDX_QUALITY = 3
     OMTF = "omtf"
     OMTF_SHAPE = [6]
     HITS_FULL = "hits_full"
     HITS_REDUCED = "hits_reduced"
+    HITS_DTYPE = 'int16'
     PT_MIN = "pt_min"
     PT_MAX = "pt_max"
     EV_N = "ev_n"
     NAME = "name"
+    PT_CODE = "pt_code"
+    SIGN = "sign"
 
 
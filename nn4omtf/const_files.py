@@ -10,3 +10,18 @@ class FILE_TYPES:
     DATASET_STATISTICS = 'DATASET_STATISTICS'
     TEST_STATISTICS = 'TEST_STATISTICS'
 
+
+class FILE_FORMATS:
+    # Single compressed archive
+    NPZ = 'npz'
+    # Directory of memory-mappable `*.npy` files + `meta.json`
+    NPY = 'npy'
+
+
+class COMPRESSION:
+    # Stored as is, arrays can be memory-mapped
+    NONE = 'none'
+    # Deflate, lowest level
+    FAST = 'fast'
+    # Deflate, highest level, for archived files
+    MAX = 'max'
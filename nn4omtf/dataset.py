@@ -6,19 +6,274 @@
     OMTF dataset generation and balancing.
 """
 
+import multiprocessing
 import numpy as np
 import os
 
-from nn4omtf.const_files import FILE_TYPES
+from nn4omtf.const_files import FILE_TYPES, FILE_FORMATS, COMPRESSION
+from nn4omtf.utils import load_npz_or_npy_dir, cast_checked,\
+    rows_multiset_hash, int_value_counts, histogram_of_counts, save_npz,\
+    load_npz_header, StageProfiler, dict_to_json
+from nn4omtf.dataset_files import blocks, create_field_array,\
+    save_dataset_dir, save_dataset_npz, get_dataset_phases,\
+    iter_dataset_shards, load_dataset_phase, load_dataset_header,\
+    load_dataset_head, sparse_hits_full, pad_sparse, take_dataset_rows
 from nn4omtf.const_dataset import DATASET_TYPES, HIST_TYPES, DATA_TYPES,\
-    HIST_SCOPES, ORD_TYPES, NPZ_DATASET, DATASET_FIELDS, DSET_STAT_FIELDS
+    HIST_SCOPES, ORD_TYPES, NPZ_DATASET, NPZ_FIELDS, DATASET_FIELDS,\
+    DSET_STAT_FIELDS, DATASET_DTYPES, PROFILE_STAGES, HITS_FULL_PADDING,\
+    NPZ_INDEX
+from nn4omtf.dataset_index import load_index, index_select, index_count,\
+    is_index_valid
+from nn4omtf.dataset_catalog import OMTFSourceCatalog
+
+
+UNSHUFFLED_SUFFIX = '.unshuffled'
+
+
+def transform_hits(hits, transform):
+    """
+    Apply data transformation on HITS array.
+    Set new NULL value and shift others.
+    Args:
+        hits: HITS array
+        transform: (null value, shift value)
+    """
+    hits = np.where(hits >= 5400, transform[0], 
+            hits.astype(np.int32) + transform[1])
+    return cast_checked(hits, DATASET_DTYPES[DATASET_FIELDS.HITS])
+
+
+def calc_histograms(index, transform, bins):
+    """
+    Calculate histograms of HITS values and HITS averaged over single 
+    event, for original and transformed data.
+    Histograms are calculated from source file index, HITS array
+    is not read. Only distinct values and per-event sums are binned.
+    Args:
+        index: source file index, see `nn4omtf.dataset_index`
+        transform: (null value, shift value) or None
+        bins: histograms bins edges
+    Returns:
+        dict( data type: dict( hist type: histogram ) )
+    """
+    hists = {DATA_TYPES.ORIG: dict(), DATA_TYPES.TRANS: dict()}
+    m = index[NPZ_INDEX.HITS_SIZE]
+    vals = index[NPZ_INDEX.VALS]
+    vals_n = index[NPZ_INDEX.VALS_N]
+    sums_vals, sums_n = int_value_counts(index[NPZ_INDEX.SUMS])
+    hists[DATA_TYPES.ORIG][HIST_TYPES.VALS] = histogram_of_counts(
+            vals, vals_n, bins)
+    hists[DATA_TYPES.ORIG][HIST_TYPES.AVG] = histogram_of_counts(
+            sums_vals / m, sums_n, bins)
+    if transform is None:
+        return hists
+
+    t_null, t_shift = transform
+    t_vals = np.where(vals >= 5400, t_null, vals + t_shift)
+    hists[DATA_TYPES.TRANS][HIST_TYPES.VALS] = histogram_of_counts(
+            t_vals, vals_n, bins)
+    # Sum of transformed values in event:
+    # NULL hits are replaced, other hits are shifted
+    null_n = index[NPZ_INDEX.NULL_N].astype(np.int64)
+    t_sums = index[NPZ_INDEX.VALID_SUMS] + null_n * t_null + \
+            (m - null_n) * t_shift
+    t_sums_vals, t_sums_n = int_value_counts(t_sums)
+    hists[DATA_TYPES.TRANS][HIST_TYPES.AVG] = histogram_of_counts(
+            t_sums_vals / m, t_sums_n, bins)
+    return hists
+
+
+def get_file_partition(partition, g_tot, n_tot, good_n, null_n):
+    """
+    Scale partition for file which doesn't have enough events.
+    Args:
+        partition: list of segments [(gb, ge, nb, ne), ...] for each phase,
+            see `OMTFDataset.get_partition`
+        g_tot: number of good examples required from file
+        n_tot: number of null examples required from file
+        good_n: number of good events in file
+        null_n: number of null events in file
+    Returns:
+        scaled partition and (good_f, null_f) scales
+    """
+    good_f = 1
+    null_f = 1
+    if null_n < n_tot:
+        null_f = null_n / n_tot
+    if good_n < g_tot:
+        good_f = good_n / g_tot
+    bounds = [[(int(gb * good_f), int(ge * good_f), 
+        int(nb * null_f), int(ne * null_f)) for gb, ge, nb, ne in segments]
+        for segments in partition]
+    return bounds, (good_f, null_f)
+
+
+def get_slices_len(bounds, good_n, null_n):
+    """
+    Get number of good and null examples taken from file for each phase.
+    """
+    return [(sum([max(0, min(ge, good_n) - min(gb, good_n)) 
+        for gb, ge, _, _ in segments]),
+        sum([max(0, min(ne, null_n) - min(nb, null_n)) 
+        for _, _, nb, ne in segments])) for segments in bounds]
+
+
+def kfold_splits(folds_n, **spec):
+    """
+    Get split specifications of K-fold cross-validation datasets.
+    Args:
+        folds_n: number of folds
+        spec: other `OMTFDataset.get_split` parameters
+    Returns:
+        list of `folds_n` specifications, see `OMTFDataset.generate`
+    """
+    return [dict(spec, kfold=(k, folds_n)) for k in range(folds_n)]
+
+
+def process_file(fn, splits, transform, bins):
+    """
+    Read single converted file, calculate its histograms and take 
+    good and null examples for each dataset phase.
+    File is read and reduced once for all generated datasets.
+    Args:
+        fn: path to `*.npz` file or `*.npy` directory
+        splits: list of (phases, g_tot, n_tot, treshold) for each 
+            generated dataset, see `OMTFDataset.get_task`
+            - phases: list of (phase name, segments, fields),
+                see `OMTFDataset.get_partition`
+            - g_tot: number of good examples required from file
+            - n_tot: number of null examples required from file
+            - treshold: filter threshold applied on mean over hits array
+        transform: (null value, shift value) or None
+        bins: histograms bins edges
+    Returns:
+        dict with keys:
+            'signature': (pt code, sign)
+            'hists': dict( data type: dict( hist type: histogram ) )
+            'splits': list of dicts for each dataset:
+                'events': (good events n, null events n)
+                'phases': list of (phase name, good n, null n, 
+                    dict( field name: good examples followed by null ones ) )
+            'profile': resources used by stages, see `PROFILE_STAGES`
+    """
+    prof = StageProfiler()
+    print('Reading data from: %s' % fn)
+    with prof.stage(PROFILE_STAGES.LOAD):
+        # Arrays are read on access, `*.npy` directories are mmapped
+        data = load_npz_or_npy_dir(fn, mmap_mode='r')
+        hits = cast_checked(data[NPZ_DATASET.HITS_REDUCED], 
+                DATASET_DTYPES[DATASET_FIELDS.HITS])
+        prod = data[NPZ_DATASET.PROD]
+        omtf = data[NPZ_DATASET.OMTF]
+        code = data[NPZ_DATASET.PT_CODE]
+        sign = data[NPZ_DATASET.SIGN]
+        hits_full = None
+        if any([DATASET_FIELDS.HITS_FULL_POS in fields 
+                for phases, _, _, _ in splits for _, _, fields in phases]):
+            hits_full = data[NPZ_DATASET.HITS_FULL]
+    signature = (code, sign)
+    with prof.stage(PROFILE_STAGES.MEAN_MASK):
+        # Means and sorted order of events are taken from index
+        index = load_index(fn, hits=hits)
+    with prof.stage(PROFILE_STAGES.HISTOGRAM):
+        hists = calc_histograms(index, transform, bins)
+    print('Events available in file: %d' % index[NPZ_INDEX.EV_N])
+    
+    file_data = {
+        DATASET_FIELDS.HITS: hits,
+        DATASET_FIELDS.PT_VAL: prod[:, NPZ_FIELDS.PROD_IDX_PT],
+        DATASET_FIELDS.SIGN: prod[:, NPZ_FIELDS.PROD_IDX_SIGN],
+        DATASET_FIELDS.OMTF_PT: omtf[:, NPZ_FIELDS.OMTF_IDX_PT],
+        DATASET_FIELDS.OMTF_SIGN: omtf[:, NPZ_FIELDS.OMTF_IDX_SIGN],
+        DATASET_FIELDS.OMTF_QUALITY: omtf[:, NPZ_FIELDS.OMTF_IDX_QUALITY]
+    }
+    # Many datasets take most of events, so all HITS are transformed once
+    trans_hits = None
+    if transform is not None and len(splits) > 1:
+        with prof.stage(PROFILE_STAGES.TRANSFORM):
+            trans_hits = transform_hits(hits, transform)
+
+    masks = dict()
+    res_splits = []
+    for phases, g_tot, n_tot, treshold in splits:
+        if treshold not in masks:
+            with prof.stage(PROFILE_STAGES.MEAN_MASK):
+                masks[treshold] = index_select(index, treshold)
+        good_idx, null_idx = masks[treshold]
+        good_n = good_idx.shape[0]
+        null_n = null_idx.shape[0]
+        print('Treshold: %f' % treshold)
+        print('   good: %d' % good_n)
+        print('   null: %d' % null_n)
+
+        if null_n < n_tot:
+            print('Not enough null events in file: %s' % fn)
+            print('Required null: %d' % (n_tot))
+            print('Scaling number of null examples')
+        if good_n < g_tot:
+            print('Not enough events in file: %s' % fn)
+            print('Required good: %d' % (g_tot))
+            print('Scaling number of good examples')
+        bounds, _ = get_file_partition([b for _, b, _ in phases], 
+                g_tot, n_tot, good_n, null_n)
+
+        res_phases = []
+        for (name, _, fields), segments in zip(phases, bounds):
+            # Only examples taken into dataset are copied
+            good = np.concatenate([good_idx[gb:ge] 
+                for gb, ge, _, _ in segments])
+            null = np.concatenate([null_idx[nb:ne] 
+                for _, _, nb, ne in segments])
+            idx = np.concatenate([good, null])
+            _good_n = good.shape[0]
+            _null_n = null.shape[0]
+            sparse = dict()
+            if DATASET_FIELDS.HITS_FULL_POS in fields:
+                with prof.stage(PROFILE_STAGES.SPARSE):
+                    sparse = dict(zip([DATASET_FIELDS.HITS_FULL_POS, 
+                        DATASET_FIELDS.HITS_FULL_VAL], 
+                        sparse_hits_full(hits_full[idx], transform)))
+            res = dict()
+            for f in fields:
+                stage = PROFILE_STAGES.SLICING
+                if f == DATASET_FIELDS.HITS and trans_hits is None and \
+                        transform is not None:
+                    stage = PROFILE_STAGES.TRANSFORM
+                with prof.stage(stage):
+                    if f == DATASET_FIELDS.IS_NULL:
+                        arr = np.arange(idx.shape[0]) >= _good_n
+                    elif f == DATASET_FIELDS.PT_CODE:
+                        arr = np.full(idx.shape[0], code)
+                    elif f == DATASET_FIELDS.HITS and trans_hits is not None:
+                        arr = trans_hits[idx]
+                    elif f == DATASET_FIELDS.HITS and transform is not None:
+                        arr = transform_hits(file_data[f][idx], transform)
+                    elif f in sparse:
+                        arr = sparse[f]
+                    else:
+                        arr = file_data[f][idx]
+                    res[f] = cast_checked(arr, DATASET_DTYPES[f])
+            res_phases.append((name, _good_n, _null_n, res))
+        res_splits.append({'events': (int(good_n), int(null_n)), 
+            'phases': res_phases})
+    data.close()
+    return {'signature': signature, 'hists': hists, 'splits': res_splits,
+        'profile': prof.stages}
+
+
+def _process_file_worker(task):
+    """
+    Pool worker, unpacks `process_file` arguments.
+    """
+    return process_file(*task)
 
 
 class OMTFDataset:
     """
     Balanced dataset preparation + statistical analysis.
 
-    Datasets are generated from given set of `*.npz` files.
+    Datasets are generated from given set of `*.npz` files or `*.npy`
+    directories (memory-mapped on read).
     It's assumed that:
     - each source file was created by ROOT-to-numpy converter and 
       has proper inner structure,
@@ -36,6 +291,12 @@ class OMTFDataset:
     those which HITS array doesn't contain sufficient amout of data. 
     (Looks like no hit was registered by sensor in detector.)
     `treshold` parameter acts on averaged HITS array for each single event.
+    Event means are taken from sidecar index of each source file, 
+    so HITS aren't reduced again for each generated dataset, see
+    `nn4omtf.dataset_index`.
+    Many thresholds can be checked at once without generation, 
+    see `scan_tresholds`. Partition and files without enough events
+    can be checked before generation, see `dry_run`.
 
     # HITS values transformation
 
@@ -45,6 +306,11 @@ class OMTFDataset:
     - all elements equals 5400 are mapped on `null value`
     - for the rest `+ shift` is applied
 
+    # Data types
+
+    Dataset fields are stored in compact types defined in `DATASET_DTYPES`,
+    e.g. HITS as int16. Transformed HITS must fit in that type.
+
     # Balancing dataset
 
     Let `N` be the number of examples in whole dataset and `F` number of 
@@ -72,6 +338,26 @@ class OMTFDataset:
     Original and final dataset distributions are available as 
     `train_examples_order`.
 
+    # Datasets bigger than memory
+
+    If `outdir` is passed to `generate`, examples from each file are
+    written directly into memory-mapped `*.npy` files (one per phase and 
+    field) and then shuffled block by block. Only single source file and
+    single block of examples are kept in memory.
+
+    # Many datasets in single pass
+
+    `generate` accepts list of split specifications (sizes, threshold,
+    seed, K-fold fold), all datasets are filled while source files are
+    read once, see `get_split` and `kfold_splits`.
+
+    # Appending files
+
+    Dataset loaded by `OMTFDataset.load` can be extended with new files,
+    see `append`. Number of available events of each file is stored
+    in statistics, so partition can be recalculated without reading
+    old files.
+
     # Dataset statistics available
      
     - TRAIN examples ordering `ORIG` and 'SHUF`
@@ -79,19 +365,30 @@ class OMTFDataset:
             containing data from all files):
       - averaged HITS per example for original and transformed input
       - HITS values for original and transformed input
+    - source files, phases sizes and events available in each file
     """
     
     def __init__(self, files, train_n, valid_n, test_n, treshold=5400., 
-            transform=(0, 600), hist_bins=(-800, 5400, 80)):
+            transform=(0, 600), hist_bins=(-800, 5400, 80), 
+            block_size=2**20, seed=None, kfold=None, hits_full=False):
         """
         Args:
-            files: list of paths to files created by ROOT-TO-NUMPY converter
+            files: list of paths to files (or `*.npy` directories) 
+                created by ROOT-TO-NUMPY converter
             train_n: number of events in train dataset
             valid_n: number of events in valid dataset
             test_n: number of events in test dataset
             treshold: filter threshold applied on mean over hits array before transformation
             transform: (null value, shift value)
-            
+            block_size: number of examples processed at once when
+                dataset is stored in memory-mapped files
+            seed: seed of examples shuffling, random if None,
+                it's saved in statistics and dataset metadata
+            kfold: (k, K) - k-th of K folds of examples from TRAIN and 
+                VALID phases is used as VALID phase, the rest as TRAIN,
+                see `get_partition`
+            hits_full: store also full HITS tensors in sparse form,
+                see `nn4omtf.dataset_files.sparse_hits_full`
         """
         self.hist_types = [HIST_TYPES.AVG, HIST_TYPES.VALS]
         self.data_types = [DATA_TYPES.ORIG, DATA_TYPES.TRANS]
@@ -115,6 +412,14 @@ class OMTFDataset:
                     HIST_SCOPES.CODE: []}
             self.histograms[dtype] = hists
         self.transform = transform
+        self.block_size = block_size
+        self.outdir = None
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.kfold = kfold
+        self.hits_full = hits_full
+        self.profiler = StageProfiler()
  
 
     def moving_avg(self, arr, wnd_size=32):
@@ -125,6 +430,13 @@ class OMTFDataset:
     def get_partition(self):
         """
         Get per data-file partitioning to get wanted distribution.
+        Returns:
+            (partition, g_tot, n_tot)
+            - partition: list of segments [(gb, ge, nb, ne), ...] for 
+                each phase; good events `[gb, ge)` and null events 
+                `[nb, ne)` of file are taken into phase
+            - g_tot, n_tot: number of good and null events required 
+                from single file
         """
         files_n = len(self.files)
         M = files_n + 1
@@ -148,50 +460,111 @@ class OMTFDataset:
             print("events per file: %d" % events_per_file)
             print("null events per file: %d" % nulls_per_file)
             print("good events per file: %d" % good_per_file)
-            partition.append((g_tot, g_tot + good_per_file, 
-                n_tot, n_tot + nulls_per_file))
+            partition.append([(g_tot, g_tot + good_per_file, 
+                n_tot, n_tot + nulls_per_file)])
             n_tot += nulls_per_file
             g_tot += good_per_file
         print("Events taken from single file:")
         print("total: {}, good: {}, null: {}".format(g_tot+n_tot, g_tot, n_tot))
+        if self.kfold is not None:
+            partition = self.get_kfold_partition(partition)
         return partition, g_tot, n_tot
+
+
+    def get_kfold_partition(self, partition):
+        """
+        Split events of TRAIN and VALID phases into K folds.
+        k-th fold is taken as VALID phase, other folds as TRAIN phase.
+        TEST phase is the same for all folds.
+        """
+        k, folds_n = self.kfold
+        assert 0 <= k < folds_n, "Wrong fold: %d of %d!" % (k, folds_n)
+        _, pg, _, pn = partition[1][0]
+        gb = pg * k // folds_n
+        ge = pg * (k + 1) // folds_n
+        nb = pn * k // folds_n
+        ne = pn * (k + 1) // folds_n
+        print("Fold %d of %d" % (k, folds_n))
+        print("good events per file: TRAIN: {}, VALID: {}".format(
+            pg - (ge - gb), ge - gb))
+        return [[(0, gb, 0, nb), (ge, pg, ne, pn)], [(gb, ge, nb, ne)], 
+                partition[2]]
+
+
+    def get_task(self, partition, g_tot, n_tot):
+        """
+        Get description of dataset passed to `process_file`.
+        """
+        phases = [(name, bounds, self.get_fields(name)) 
+                for name, bounds in zip(self.names, partition)]
+        return (phases, g_tot, n_tot, self.treshold)
+
+
+    def get_split(self, train_n=None, valid_n=None, test_n=None, 
+            treshold=None, seed=None, kfold=None):
+        """
+        Create dataset of same source files, transformation and 
+        histograms bins but different split parameters. 
+        Parameters which are not given are taken from this dataset.
+        Returns:
+            OMTFDataset object
+        """
+        phase_n = [n if n is not None else d for n, d in 
+                zip([train_n, valid_n, test_n], self.phase_n)]
+        return OMTFDataset(self.files, *phase_n, 
+                treshold=treshold if treshold is not None else self.treshold,
+                transform=self.transform, 
+                hist_bins=(self.bins[0], self.bins[-1], self.bins.shape[0]),
+                block_size=self.block_size, 
+                seed=seed if seed is not None else self.seed,
+                kfold=kfold if kfold is not None else self.kfold,
+                hits_full=self.hits_full)
     
 
-    def add_histograms_for_file(self, hits, htype=HIST_TYPES.VALS, 
+    def add_histograms(self, hist, htype=HIST_TYPES.VALS, 
             dtype=DATA_TYPES.ORIG):
         """
-        Get hits and hits averaged over single event and add histograms data.
+        Add histogram of hits or hits averaged over single event 
+        calculated for single file.
         """
-        hist, _ = np.histogram(hits, bins=self.bins)
         self.histograms[dtype][htype][HIST_SCOPES.CODE].append(hist)
         self.histograms[dtype][htype][HIST_SCOPES.TOTAL] += hist
         
 
-    def dataset_validator(self, data, shuffled=False):
+    def get_fields(self, name):
         """
-        Validate shuffled dataset by checking whether examples match.
-        Creates 2D histograms of pairs:
-        - (hits_avg, pt_value)
-        - (hits_avg, omtf_pt_value)
-        - (pt_value, omtf_pt_value)
+        Get fields stored in given dataset phase.
+        OMTF fields are used only by statistics module, 
+        so they are stored only in TEST phase.
         """
-        hist_avg = np.mean(data[0], axis=(1,2))
-        ps = data[1][:,0] # Get muon PT value
-        os = data[2][:,1] # Get OMTF PT value
-        hists = (np.histogram2d(hist_avg, ps)[0], 
-            np.histogram2d(hist_avg, os)[0],
-            np.histogram2d(ps, os)[0])
-        if not shuffled:
-            self.valid_hists = hists
-            return
-        orig_hists = self.valid_hists
-        self.valid_hists = {
-            ORD_TYPES.ORIG: self.valid_hists,
-            ORD_TYPES.SHUF: hists}
-        for orig, shuf in zip(orig_hists, hists):
-            if not np.all(np.equal(orig, shuf)):
-                return False
-        return True
+        fields = [
+            DATASET_FIELDS.HITS,
+            DATASET_FIELDS.PT_VAL,
+            DATASET_FIELDS.SIGN,
+            DATASET_FIELDS.IS_NULL,
+            DATASET_FIELDS.PT_CODE]
+        if name == DATASET_TYPES.TEST:
+            fields += [
+                DATASET_FIELDS.OMTF_PT,
+                DATASET_FIELDS.OMTF_SIGN,
+                DATASET_FIELDS.OMTF_QUALITY]
+        if self.hits_full:
+            fields += [
+                DATASET_FIELDS.HITS_FULL_POS,
+                DATASET_FIELDS.HITS_FULL_VAL]
+        return fields
+
+
+    def dataset_checksum(self, data):
+        """
+        Calculate order independent checksum of dataset examples.
+        It's used to check whether shuffled dataset contains same 
+        examples. Examples are hashed in blocks, 
+        see `nn4omtf.utils.rows_multiset_hash`.
+        """
+        fields = sorted(data.keys())
+        return rows_multiset_hash([data[f] for f in fields], 
+                block_size=self.block_size)
     
     
     def save_train_examples_ordering(self, train_dataset, shuffled=False):
@@ -199,172 +572,554 @@ class OMTFDataset:
         Apply moving average on mouns PT value arrays and check
         if examples are shuffled well.
         """
-        ps_avg = self.moving_avg(train_dataset[1][:, 0])
+        ps_avg = self.moving_avg(train_dataset[DATASET_FIELDS.PT_VAL])
         if not shuffled:
             self.train_examples_order = {ORD_TYPES.ORIG: ps_avg}
         else:
             self.train_examples_order[ORD_TYPES.SHUF] = ps_avg
         
 
-    def generate(self):
+    def shuffle_phase(self, name, data, rng):
+        """
+        Shuffle phase arrays.
+        Single permutation is applied on all fields, each field is 
+        gathered once. Memory-mapped arrays stored in `self.outdir` are
+        gathered block by block into new files, so only single block 
+        of data is kept in memory.
+        Args:
+            name: phase name
+            data: dict( field name: unshuffled array )
+            rng: `np.random.Generator` instance
+        Returns:
+            dict( field name: shuffled array )
+        """
+        n = data[DATASET_FIELDS.HITS].shape[0]
+        perm = rng.permutation(n)
+        if self.outdir is None:
+            return dict([(f, arr[perm]) for f, arr in data.items()])
+
+        res = dict()
+        for field, arr in data.items():
+            out = create_field_array(self.outdir, name, field, n, 
+                    arr.shape[1:], arr.dtype)
+            for b in blocks(n, self.block_size):
+                # Read source in ascending order of indices
+                idx = perm[b]
+                order = np.argsort(idx)
+                out[b][order] = arr[idx[order]]
+            out.flush()
+            fn = arr.filename
+            del arr
+            data[field] = None
+            os.remove(fn)
+            res[field] = out
+        return res
+
+
+    def generate(self, outdir=None, jobs=1, splits=None):
         """
         Generate balanced datasets.
+        Many datasets (e.g. of different sizes, thresholds or K-fold
+        splits) can be generated in single pass over source files,
+        each file is read and reduced only once.
+        Args:
+            outdir: if not None, datasets are not kept in memory but
+                written directly into memory-mapped files in `outdir` 
+                directory, see `nn4omtf.dataset_files`
+            jobs: number of processes reading source files,
+                examples are always placed in order of files
+            splits: list of dicts with parameters of additional datasets,
+                see `get_split` and `kfold_splits`; optional key `outdir`
+                is `outdir` of that dataset
+        Returns:
+            list of datasets generated from `splits`
+        """
+        datasets = [self]
+        outdirs = [outdir]
+        for spec in splits or []:
+            spec = dict(spec)
+            outdirs.append(spec.pop('outdir', None))
+            datasets.append(self.get_split(**spec))
+        used = [o for o in outdirs if o is not None]
+        assert len(used) == len(set(used)), "Datasets must have different outdirs!"
+        # Single report for whole pass
+        for d in datasets:
+            d.profiler = self.profiler
+        
+        with self.profiler.stage(PROFILE_STAGES.GENERATE):
+            splits = [d.init_generation(o) for d, o in zip(datasets, outdirs)]
+            tasks = [(fn, splits, self.transform, self.bins) 
+                    for fn in self.files]
+            for res in self.process_files(tasks, jobs):
+                self.profiler.merge(res['profile'])
+                for d, split in zip(datasets, res['splits']):
+                    d.add_file(res['signature'], res['hists'], split)
+            for d in datasets:
+                d.finish_generation()
+        return datasets[1:]
+
+
+    def init_generation(self, outdir=None):
+        """
+        Prepare dataset generation, see `generate`.
+        Returns:
+            dataset description passed to `process_file`
         """
+        self.outdir = outdir
         partition, g_tot, n_tot = self.get_partition()
-        dataset = dict(zip(self.names, [None] * 3))
+        self.init_examples(partition)
+        self.signatures = []
+        self.events = []
+        return self.get_task(partition, g_tot, n_tot)
+
+
+    def init_examples(self, partition):
+        """
+        Prepare empty dataset filled file by file, see `add_examples`.
+        """
+        files_n = len(self.files)
+        # Output arrays are allocated once, when first file is read.
+        # Each file gives at most nominal number of examples per phase.
+        self.dataset = dict(zip(self.names, [None] * 3))
+        self.capacity = dict([(name, files_n * sum([ge - gb + ne - nb 
+            for gb, ge, nb, ne in segments])) 
+            for segments, name in zip(partition, self.names)])
+        self.cursor = dict(zip(self.names, [0] * 3))
         # Do NOT use [[]] * 3 here !!
-        signatures_distr = dict(zip(self.names, [[], [], []]))
-        signatures = []
+        self.signatures_distr = dict(zip(self.names, [[], [], []]))
 
-        for fn in self.files:
-            print('Reading data from: %s' % fn)
-            data = np.load(fn)
-            hits = data[NPZ_DATASET.HITS_REDUCED]
-            prod = data[NPZ_DATASET.PROD]
-            omtf = data[NPZ_DATASET.OMTF]
-            code = data[NPZ_DATASET.PT_CODE]
-            sign = data[NPZ_DATASET.SIGN]
-            signatures.append((code, sign))
 
-            
-            # Calc histogram of original input values
-            hits_avg = np.mean(hits, axis=(1,2))
-            self.add_histograms_for_file(hits, htype=HIST_TYPES.VALS, 
-                    dtype=DATA_TYPES.ORIG)
-            self.add_histograms_for_file(hits_avg, htype=HIST_TYPES.AVG, 
-                    dtype=DATA_TYPES.ORIG)
-            
-            good_mask = hits_avg < self.treshold
-            good_n = np.sum(good_mask)
-            null_mask = hits_avg >= self.treshold
-            null_n = np.sum(null_mask)
-            good_f = 1
-            null_f = 1
-            print('Events available in file: %d', hits_avg.shape[0])
-            print('   good: %d', good_n)
-            print('   null: %d', null_n)
-
-            if null_n < n_tot:
-                print('Not enough null events in file: %s' % fn)
-                print('Required null: %d' % (n_tot))
-                print('Scaling number of null examples')
-                null_f = null_n / n_tot
-            if good_n < g_tot:
-                print('Not enough events in file: %s' % fn)
-                print('Required good: %d' % (g_tot))
-                print('Scaling number of good examples')
-                good_f = good_n / g_tot
-            
-            if self.transform is not None:
-                # Apply data transformation
-                # Set new NULL value and shift others
-                hits = np.where(hits >= 5400, self.transform[0], 
-                        hits + self.transform[1])
-                hits_avg = np.mean(hits, axis=(1,2))
-                self.add_histograms_for_file(hits, htype=HIST_TYPES.VALS, 
-                        dtype=DATA_TYPES.TRANS)
-                self.add_histograms_for_file(hits_avg, htype=HIST_TYPES.AVG, 
-                        dtype=DATA_TYPES.TRANS)
-            
-            file_data = [hits, prod, omtf]
-            good_data = [t[good_mask] for t in file_data]
-            good_data += [np.zeros(good_n).astype(np.bool)]
-            good_data += [np.ones(good_n) * code]
-            null_data = [t[null_mask] for t in file_data]
-            null_data += [np.ones(null_n).astype(np.bool)]
-            null_data += [np.ones(null_n) * code]
-
-            for (gb, ge, nb, ne), name  in zip(partition, self.names):
-                gb = int(gb * good_f)
-                ge = int(ge * good_f)
-                nb = int(nb * null_f)
-                ne = int(ne * null_f)
-                _good_data = [_data[gb:ge] for _data in good_data]
-                _null_data = [_data[nb:ne] for _data in null_data]
-                signatures_distr[name] += [(_good_data[0].shape[0], 
-                    _null_data[0].shape[0])]
-                if dataset[name] is None:
-                    dataset[name] = [np.concatenate((_gd, _nd), axis=0) 
-                            for _gd, _nd in zip(_good_data, _null_data)]
-                else:
-                    dataset[name] = [np.concatenate((_d, _gd, _nd), axis=0) 
-                            for _d, _gd, _nd in 
-                                zip(dataset[name], _good_data, _null_data)]
-            data.close()
-        
+    def add_file(self, signature, hists, split):
+        """
+        Add examples and histograms of single file.
+        Args:
+            signature, hists: see `process_file` results
+            split: results of `process_file` for this dataset
+        """
+        self.signatures.append(signature)
+        self.events.append(split['events'])
+        for dtype in self.data_types:
+            for htype, hist in hists[dtype].items():
+                self.add_histograms(hist, htype=htype, dtype=dtype)
+        self.add_examples(split['phases'])
+
+
+    def add_examples(self, phases):
+        """
+        Add examples of single file at the end of each phase.
+        Args:
+            phases: list of (phase name, good n, null n, 
+                dict( field name: array )), see `process_file` results
+        """
+        dataset = self.dataset
+        for name, _good_n, _null_n, data in phases:
+            self.signatures_distr[name] += [(_good_n, _null_n)]
+            if dataset[name] is None:
+                dataset[name] = dict([(f, self.alloc_field(name, f, 
+                    self.capacity[name], arr.shape[1:])) 
+                    for f, arr in data.items()])
+            b = self.cursor[name]
+            e = b + _good_n + _null_n
+            with self.profiler.stage(PROFILE_STAGES.SLICING):
+                for f, arr in data.items():
+                    if f in HITS_FULL_PADDING:
+                        # Sparse rows are padded to widest row
+                        width = max(arr.shape[1], dataset[name][f].shape[1])
+                        arr = pad_sparse(arr, f, width)
+                        dataset[name][f] = self.widen_field(name, f, 
+                                dataset[name][f], width)
+                    dataset[name][f][b:e] = arr
+            self.cursor[name] = e
+
+
+    def widen_field(self, name, field, arr, width):
+        """
+        Pad allocated sparse HITS field array to given width.
+        Memory-mapped array is copied block by block into new file.
+        """
+        if arr.shape[1] >= width:
+            return arr
+        if self.outdir is None:
+            return pad_sparse(arr, field, width)
+        n = arr.shape[0]
+        out = create_field_array(self.outdir, name, field, n, [width], 
+                arr.dtype, suffix=UNSHUFFLED_SUFFIX + '.tmp')
+        for b in blocks(n, self.block_size):
+            out[b] = pad_sparse(arr[b], field, width)
+        out.flush()
+        fn = arr.filename
+        os.replace(out.filename, fn)
+        return np.load(fn, mmap_mode='r+')
+
+
+    def finish_generation(self):
+        """
+        Trim and shuffle generated dataset.
+        """
+        dataset = self.dataset
+        # Trim unused tail left by files with not enough events
+        for name in self.names:
+            dataset[name] = dict([(f, arr[:self.cursor[name]]) 
+                for f, arr in dataset[name].items()])
+        self.dataset = self.shuffle_dataset(dataset)
+
+
+    def shuffle_dataset(self, dataset):
+        """
+        Shuffle all phases of dataset ordered by source files 
+        and check results.
+        Phases are shuffled one by one with permutations generated 
+        from `self.seed`, see `unshuffle_dataset`.
+        Returns:
+            shuffled dataset
+        """
         self.save_train_examples_ordering(dataset[DATASET_TYPES.TRAIN])
         
+        rng = np.random.default_rng(self.seed)
         for name in self.names:
-            rng_state = np.random.get_state()
-            self.dataset_validator(dataset[name])
-            for i in range(len(dataset[name])):
-                # Shuffle each array in same way
-                np.random.shuffle(dataset[name][i])
-                np.random.set_state(rng_state)
-            assert self.dataset_validator(dataset[name], shuffled=True), \
-                    "%s dataset shuffle failed! Histograms don't match!"
+            with self.profiler.stage(PROFILE_STAGES.VALIDATION):
+                checksum = self.dataset_checksum(dataset[name])
+            with self.profiler.stage(PROFILE_STAGES.SHUFFLE):
+                dataset[name] = self.shuffle_phase(name, dataset[name], rng)
+            with self.profiler.stage(PROFILE_STAGES.VALIDATION):
+                assert checksum == self.dataset_checksum(dataset[name]), \
+                    "%s dataset shuffle failed! Checksums don't match!" % name
         
         self.save_train_examples_ordering(dataset[DATASET_TYPES.TRAIN], 
                 shuffled=True)
-        self.dataset = dataset
-        self.signatures = signatures
-        self.signatures_distr = signatures_distr
+        return dataset
+
+
+    def unshuffle_dataset(self, dataset):
+        """
+        Restore order of examples from source files.
+        Permutations are generated again from `self.seed`.
+        Returns:
+            dataset ordered by source files
+        """
+        rng = np.random.default_rng(self.seed)
+        res = dict()
+        for name in self.names:
+            n = dataset[name][DATASET_FIELDS.HITS].shape[0]
+            perm = rng.permutation(n)
+            res[name] = dict()
+            for f, arr in dataset[name].items():
+                res[name][f] = np.empty_like(arr)
+                res[name][f][perm] = arr
+        return res
+
+
+    def append(self, files, jobs=1, outdir=None):
+        """
+        Append new source files to generated dataset.
+        Dataset must be loaded with `OMTFDataset.load`.
+        Partition is calculated again for all files. Examples of old
+        files are taken from dataset, rows which don't fit new partition
+        are dropped (phases have different fields, so examples can't be 
+        moved between phases). Only new files and old files which 
+        can't give enough examples from dataset are read.
+        Number of examples per file and phase is the same as in dataset
+        generated from all files at once, but examples of old files
+        may differ. Dataset is shuffled again with the same seed.
+        Examples of old files are gathered file by file, positions in
+        shuffled dataset are found from shuffling permutations. If
+        dataset was loaded with `stream`, they are read from its 
+        memory-mapped files.
+        Args:
+            files: list of new source files
+            jobs: number of processes reading source files
+            outdir: if not None, new dataset is written into memory-mapped
+                files in `outdir` directory, see `generate`; it must differ
+                from directory of loaded dataset
+        """
+        old_files = list(self.files)
+        old_distr = self.signatures_distr
+        self.files = old_files + list(files)
+        partition, g_tot, n_tot = self.get_partition()
+        split = self.get_task(partition, g_tot, n_tot)
+
+        # Old dataset phases and positions of examples ordered by 
+        # source files in shuffled phases, see `unshuffle_dataset`
+        rng = np.random.default_rng(self.seed)
+        shards = dict()
+        positions = dict()
+        for name in self.names:
+            if self.dataset is None:
+                shards[name] = list(iter_dataset_shards(self.ds_path, name))
+            else:
+                shards[name] = [self.dataset[name]]
+            n = sum([s[DATASET_FIELDS.HITS].shape[0] for s in shards[name]])
+            perm = rng.permutation(n)
+            positions[name] = np.empty_like(perm)
+            positions[name][perm] = np.arange(n)
+
+        # Examples of old files, taken from dataset
+        parts = [None] * len(self.files)
+        cursor = dict(zip(self.names, [0] * 3))
+        to_read = []
+        for i, fn in enumerate(old_files):
+            good_n, null_n = self.events[i]
+            bounds, _ = get_file_partition(partition, g_tot, n_tot, 
+                    good_n, null_n)
+            lens = get_slices_len(bounds, good_n, null_n)
+            parts[i] = []
+            for name, (_good_n, _null_n) in zip(self.names, lens):
+                old_good_n, old_null_n = old_distr[name][i]
+                b = cursor[name]
+                cursor[name] = b + old_good_n + old_null_n
+                if _good_n > old_good_n or _null_n > old_null_n:
+                    continue
+                # Good examples are followed by null examples of file
+                idx = np.concatenate([np.arange(b, b + _good_n), 
+                    np.arange(b + old_good_n, b + old_good_n + _null_n)])
+                parts[i].append((name, _good_n, _null_n, idx))
+            if len(parts[i]) < len(self.names):
+                print('Not enough examples of %s in dataset' % fn)
+                to_read.append(i)
+        to_read += list(range(len(old_files), len(self.files)))
+
+        # Dataset is filled again in order of files
+        self.outdir = outdir
+        self.init_examples(partition)
+        tasks = [(self.files[i], [split], self.transform, self.bins) 
+                for i in to_read]
+        results = self.process_files(tasks, jobs)
+        read = set(to_read)
+        for i in range(len(self.files)):
+            if i not in read:
+                with self.profiler.stage(PROFILE_STAGES.SLICING):
+                    phases = [(name, _good_n, _null_n, take_dataset_rows(
+                        shards[name], positions[name][idx])) 
+                        for name, _good_n, _null_n, idx in parts[i]]
+                self.add_examples(phases)
+                continue
+            res = next(results)
+            self.profiler.merge(res['profile'])
+            if i >= len(old_files):
+                self.signatures.append(res['signature'])
+                self.events.append(res['splits'][0]['events'])
+                for dtype in self.data_types:
+                    for htype, hist in res['hists'][dtype].items():
+                        self.add_histograms(hist, htype=htype, dtype=dtype)
+            self.add_examples(res['splits'][0]['phases'])
+        shards = None
+        self.finish_generation()
+
+
+    def process_files(self, tasks, jobs=1):
+        """
+        Process source files in given order.
+        Files are read by pool of `jobs` processes, at most `jobs` 
+        results are kept in memory at once.
+        Args:
+            tasks: list of `process_file` arguments
+            jobs: number of processes
+        Returns:
+            generator of `process_file` results
+        """
+        if jobs <= 1:
+            for task in tasks:
+                yield process_file(*task)
+            return
+        with multiprocessing.Pool(jobs) as pool:
+            for i in range(0, len(tasks), jobs):
+                for res in pool.map(_process_file_worker, tasks[i:i + jobs]):
+                    yield res
+
+
+    def scan_tresholds(self, tresholds, jobs=1):
+        """
+        Check what `generate` would produce for many thresholds.
+        Only source files indices are read, datasets are not generated,
+        see `nn4omtf.dataset_index`.
+        Args:
+            tresholds: list of thresholds
+            jobs: number of processes reading source files
+        Returns:
+            list of dicts for each threshold with keys:
+                'treshold': threshold
+                'files': list of (signature, good n, null n, good_f, null_f)
+                    for each file, scales are applied by `generate` if
+                    file doesn't have enough events
+                'phase_n': number of examples generated in each phase
+                'max_phase_n': largest phases sizes of same proportions
+                    which don't require scaling in any file
+        """
+        partition, g_tot, n_tot = self.get_partition()
+        with self.profiler.stage(PROFILE_STAGES.MEAN_MASK):
+            if jobs <= 1:
+                indices = [load_index(fn) for fn in self.files]
+            else:
+                with multiprocessing.Pool(jobs) as pool:
+                    indices = pool.map(load_index, self.files)
+        results = []
+        for treshold in tresholds:
+            files = []
+            phase_n = [0] * len(self.names)
+            scale = np.inf
+            for index in indices:
+                good_n, null_n = index_count(index, treshold)
+                bounds, (good_f, null_f) = get_file_partition(partition,
+                        g_tot, n_tot, good_n, null_n)
+                for i, (g, n) in enumerate(
+                        get_slices_len(bounds, good_n, null_n)):
+                    phase_n[i] += g + n
+                if g_tot > 0:
+                    scale = min(scale, good_n / g_tot)
+                if n_tot > 0:
+                    scale = min(scale, null_n / n_tot)
+                signature = (index[NPZ_INDEX.PT_CODE], index[NPZ_INDEX.SIGN])
+                files.append((signature, good_n, null_n,
+                    good_f, null_f))
+            max_phase_n = list(self.phase_n)
+            if np.isfinite(scale):
+                max_phase_n = [int(N * scale) for N in self.phase_n]
+            results.append({'treshold': treshold, 'files': files,
+                'phase_n': phase_n, 'max_phase_n': max_phase_n})
+        return results
+
+
+    def dry_run(self, catalog=None):
+        """
+        Print partition, files which don't have enough events and
+        expected size of dataset. HITS arrays are not read.
+        Numbers of good and null events are exact for files with valid
+        index (see `nn4omtf.dataset_index`), for other files only total
+        number of events is known, so best split is assumed.
+        Args:
+            catalog: `OMTFSourceCatalog` of source files, built if None
+        Returns:
+            dict with keys:
+                'phase_n': expected number of examples in each phase
+                'bytes': expected size of dataset arrays in bytes,
+                    sparse full HITS fields are not included
+                'short': list of files which will be scaled
+        """
+        partition, g_tot, n_tot = self.get_partition()
+        if catalog is None:
+            catalog = OMTFSourceCatalog(self.files)
+        phase_n = [0] * len(self.names)
+        short = []
+        hits_shape = None
+        print('=' * 10 + ' DRY RUN')
+        print("%8s %5s %10s %10s %10s %8s %8s %6s" % ('pt code', 'sign',
+            'events', 'good', 'null', 'good_f', 'null_f', 'from'))
+        for fn in self.files:
+            entry = catalog.get_entry(fn)
+            hits_shape = entry['hits_shape']
+            ev_n = entry[NPZ_FIELDS.EV_N]
+            src = 'index'
+            if is_index_valid(fn):
+                good_n, null_n = index_count(load_index(fn), self.treshold)
+            else:
+                src = 'ev_n'
+                good_n = min(ev_n, g_tot)
+                null_n = ev_n - good_n
+            bounds, (good_f, null_f) = get_file_partition(partition,
+                    g_tot, n_tot, good_n, null_n)
+            for i, (g, n) in enumerate(get_slices_len(bounds, good_n, null_n)):
+                phase_n[i] += g + n
+            if min(good_f, null_f) < 1:
+                short.append(fn)
+            print("%8d %5s %10d %10d %10d %8.3f %8.3f %6s" % (
+                entry[NPZ_FIELDS.PT_CODE], entry[NPZ_FIELDS.SIGN], ev_n,
+                good_n, null_n, good_f, null_f, src))
+
+        size = 0
+        for name, n in zip(self.names, phase_n):
+            example = 0
+            for f in self.get_fields(name):
+                if f in HITS_FULL_PADDING:
+                    continue
+                shape = hits_shape if f == DATASET_FIELDS.HITS else []
+                example += np.dtype(DATASET_DTYPES[f]).itemsize * \
+                        int(np.prod(shape))
+            size += n * example
+            print("Phase %s: %d examples, %d bytes" % (name, n, n * example))
+        print("Files to scale: %d of %d" % (len(short), len(self.files)))
+        for fn in short:
+            print("! " + fn)
+        print("Expected dataset size: %d bytes (%.1f MB)" % (size,
+            size / 2**20))
+        if self.hits_full:
+            print("Sparse full HITS fields not included, "
+                "their width depends on data")
+        return {'phase_n': phase_n, 'bytes': size, 'short': short}
+
+
+    def alloc_field(self, name, field, n, shape):
+        """
+        Allocate array for dataset field.
+        If `self.outdir` is set, array is memory-mapped file.
+        """
+        dtype = DATASET_DTYPES[field]
+        if self.outdir is None:
+            return np.empty((n,) + tuple(shape), dtype=dtype)
+        return create_field_array(self.outdir, name, field, n, shape, dtype,
+                suffix=UNSHUFFLED_SUFFIX)
         
         
-    def save_dataset(self, prefix, single_file=True):
+    def save_dataset(self, prefix, single_file=True, fmt=FILE_FORMATS.NPZ,
+            shard_size=None, compression=COMPRESSION.NONE):
         """
-        Prepare all types of datasets with approptiate structure of elements.
-        Dataset file structure is as follows:
-            dict( [ ( phase name: dict([(data name, data values)]) ) ] )
-        If `single_file` is True, all `phase_name` entries are stored in 
-        single `*.npz` file.
+        Save all types of datasets.
+        If `fmt` is `FILE_FORMATS.NPZ`, dataset is stored in single 
+        `*.npz` file with array named `PHASE/FIELD` per phase 
+        and field. If `single_file` is False, each phase is stored in 
+        separate `*.npz` file. Only arrays saved with `COMPRESSION.NONE` 
+        can be memory-mapped.
+        If `fmt` is `FILE_FORMATS.NPY`, dataset is stored as directory
+        `prefix` with `*.npy` file per phase and field.
+        Datasets generated with `outdir` can be saved only in this format, 
+        in their `outdir`.
+        If `shard_size` is given, phases in directory are split into 
+        shards of `shard_size` examples.
+        See `nn4omtf.dataset_files`.
 
-        # Example - loading dict structure from `*.npz` file
+        # Example - loading fields from `*.npz` file
         ```
-            ds_npz = np.load(ds_npz_path)
-            ds_train = ds_npz['TRAIN'].item()
-            print(ds_train['HITS']
+            ds_train = load_dataset_phase(ds_npz_path, 'TRAIN', 
+                fields=['HITS'], mmap_mode='r')
+            print(ds_train['HITS'])
         ```
         """
-        data = dict()
-
-        fields_labels = [
-            DATASET_FIELDS.HITS,
-            DATASET_FIELDS.PT_VAL,
-            DATASET_FIELDS.SIGN,
-            DATASET_FIELDS.IS_NULL,
-            DATASET_FIELDS.PT_CODE]
+        if fmt == FILE_FORMATS.NPY:
+            if self.outdir is not None:
+                assert os.path.abspath(prefix) == os.path.abspath(self.outdir),\
+                    "Dataset is already stored in %s!" % self.outdir
+            with self.profiler.stage(PROFILE_STAGES.WRITE):
+                save_dataset_dir(prefix, self.dataset, self.get_params(), 
+                        shard_size=shard_size)
+            return
 
-        test_fields_labels = [
-            DATASET_FIELDS.OMTF_PT,
-            DATASET_FIELDS.OMTF_SIGN,
-            DATASET_FIELDS.OMTF_QUALITY]
-
-        for k, v in self.dataset.items():
-            fields = [
-                v[0],
-                v[1][:,0],
-                v[1][:,3],
-                v[3],
-                v[4]]
-            if k is not DATASET_TYPES.TEST:
-                data[k] = dict(zip(fields_labels, fields))
+        assert self.outdir is None, "Dataset is stored in %s!" % self.outdir
+        with self.profiler.stage(PROFILE_STAGES.WRITE):
+            if single_file:
+                save_dataset_npz(prefix, self.dataset, 
+                        compression=compression, params=self.get_params())
             else:
-                test_fields = [
-                    v[2][:,1],
-                    v[2][:,0],
-                    v[2][:,3]]
-                data[k] = dict(zip(fields_labels + test_fields_labels, 
-                    fields + test_fields))
-        if single_file:
-            np.savez_compressed(prefix, **data)
-        else:
-            for k, v in data.items():
-                path = prefix + '-' + k.lowercase()
-                np.savez_compressed(path, **{k: v})
+                for k, v in self.dataset.items():
+                    save_dataset_npz(prefix + '-' + k.lower(), {k: v}, 
+                            compression=compression, 
+                            params=self.get_params())
     
 
-    def save_stats(self, path):
+    def get_params(self):
+        """
+        Get dataset generation parameters.
+        """
+        return {
+            'files': list(self.files),
+            'phase_n': list(self.phase_n),
+            'treshold': self.treshold,
+            'transform': self.transform,
+            'seed': self.seed,
+            'kfold': self.kfold,
+            'hits_full': self.hits_full,
+        }
+
+
+    def save_stats(self, path, compression=COMPRESSION.FAST):
         stats = dict()
         stats[DSET_STAT_FIELDS.TRAIN_EXAMPLES_ORDERING] = self.train_examples_order
 
@@ -392,9 +1147,34 @@ class OMTFDataset:
         stats[DSET_STAT_FIELDS.MUON_SIGNATURES_DISTR] = self.signatures_distr
         stats[DSET_STAT_FIELDS.TRANSFORM] = self.transform
         stats[DSET_STAT_FIELDS.TRESHOLD] = self.treshold
+        stats[DSET_STAT_FIELDS.SEED] = self.seed
+        stats[DSET_STAT_FIELDS.FILES] = list(self.files)
+        stats[DSET_STAT_FIELDS.PHASE_N] = list(self.phase_n)
+        stats[DSET_STAT_FIELDS.EVENTS] = self.events
+        stats[DSET_STAT_FIELDS.KFOLD] = self.kfold
+        # Writing of statistics is not included
+        stats[DSET_STAT_FIELDS.PROFILE] = self.profiler.get_report()
 
+        # Summary for preview, see `show`
+        header = {
+            DSET_STAT_FIELDS.MUON_SIGNATURES: [
+                [np.asarray(c).item(), np.asarray(s).item()] 
+                for c, s in self.signatures],
+            DSET_STAT_FIELDS.MUON_SIGNATURES_DISTR: self.signatures_distr,
+            DSET_STAT_FIELDS.PHASE_N: list(self.phase_n),
+            DSET_STAT_FIELDS.TRESHOLD: float(self.treshold),
+            DSET_STAT_FIELDS.TRANSFORM: self.transform,
+            DSET_STAT_FIELDS.SEED: self.seed}
         data = {FILE_TYPES.DATASET_STATISTICS: stats}
-        np.savez_compressed(path, **data)
+        with self.profiler.stage(PROFILE_STAGES.WRITE):
+            save_npz(path, compression=compression, header=header, **data)
+
+
+    def save_profile(self, path):
+        """
+        Save resources used by generation stages as JSON file.
+        """
+        dict_to_json(path, self.profiler.get_report())
 
 
     def get_train_examples_ordering(self):
@@ -405,13 +1185,85 @@ class OMTFDataset:
             self.train_examples_order[ORD_TYPE.SHUF])
 
 
+    def load(ds_path, stats_path, block_size=2**20, stream=False):
+        """
+        Load generated dataset and its statistics into memory.
+        Args:
+            ds_path: dataset file or directory
+            stats_path: statistics file
+            block_size: see `OMTFDataset.__init__`
+            stream: don't load dataset arrays, examples are read from 
+                `ds_path` when needed, see `append`. Files saved without
+                header are always loaded.
+        Returns:
+            OMTFDataset object
+        """
+        with np.load(stats_path, allow_pickle=True) as npz:
+            stats = npz[FILE_TYPES.DATASET_STATISTICS].item()
+        assert DSET_STAT_FIELDS.EVENTS in stats, \
+                "Statistics saved by older version, generate dataset again!"
+        bins = stats[DSET_STAT_FIELDS.HISTS_BINS]
+        train_n, valid_n, test_n = stats[DSET_STAT_FIELDS.PHASE_N]
+        ds = OMTFDataset(stats[DSET_STAT_FIELDS.FILES], train_n, valid_n, 
+                test_n, treshold=stats[DSET_STAT_FIELDS.TRESHOLD], 
+                transform=stats[DSET_STAT_FIELDS.TRANSFORM], 
+                hist_bins=(bins[0], bins[-1], bins.shape[0]), 
+                block_size=block_size, seed=stats[DSET_STAT_FIELDS.SEED],
+                kfold=stats.get(DSET_STAT_FIELDS.KFOLD))
+        for dtype, key in [(DATA_TYPES.ORIG, DSET_STAT_FIELDS.HISTS_ORIG),
+                (DATA_TYPES.TRANS, DSET_STAT_FIELDS.HISTS_TRANS)]:
+            for htype, hists in stats[key].items():
+                for hist in hists:
+                    ds.add_histograms(hist, htype=htype, dtype=dtype)
+        ds.signatures = list(stats[DSET_STAT_FIELDS.MUON_SIGNATURES])
+        ds.signatures_distr = stats[DSET_STAT_FIELDS.MUON_SIGNATURES_DISTR]
+        ds.events = list(stats[DSET_STAT_FIELDS.EVENTS])
+        ds.ds_path = ds_path
+        header = load_dataset_header(ds_path) if stream else None
+        if header is None:
+            ds.dataset = dict([(name, load_dataset_phase(ds_path, name, 
+                mmap_mode=None)) for name in ds.names])
+            fields = ds.dataset[DATASET_TYPES.TRAIN]
+        else:
+            ds.dataset = None
+            fields = header['phases'][DATASET_TYPES.TRAIN]['fields']
+        ds.hits_full = DATASET_FIELDS.HITS_FULL_POS in fields
+        return ds
+
+
     def show(path, n=5):
-        npz = np.load(path)
-        if DSET_STAT_FIELDS.GROUP_NAME in npz.files:
-            OMTFDataset._show_stats(npz[DSET_STAT_FIELDS.GROUP_NAME].item())
+        """
+        Print preview of dataset or statistics file.
+        Only files headers and first `n` examples of each phase are read,
+        whole arrays are loaded only for files saved by older versions.
+        """
+        if not os.path.isdir(path):
+            header = load_npz_header(path) or dict()
+            if DSET_STAT_FIELDS.MUON_SIGNATURES in header:
+                OMTFDataset._show_stats(header)
+                return
+            with np.load(path, allow_pickle=True) as npz:
+                if FILE_TYPES.DATASET_STATISTICS in npz.files:
+                    OMTFDataset._show_stats(
+                            npz[FILE_TYPES.DATASET_STATISTICS].item())
+                    return
+        header = load_dataset_header(path)
+        phases = get_dataset_phases(path)
         for name in [n for n in vars(DATASET_TYPES) if not n.startswith('_')]:
-            if name in npz.files:
-                OMTFDataset._show_dataset(name, npz[name].item(), n)
+            if name in phases:
+                if header is not None:
+                    OMTFDataset._show_phase_meta(name, header['phases'][name])
+                data = load_dataset_head(path, name, n)
+                OMTFDataset._show_dataset(name, data, n)
+
+
+    def _show_phase_meta(name, meta):
+        print('=' * 10 + ' PHASE ' + name)
+        print('examples: %d' % meta['n'])
+        for field, desc in meta['fields'].items():
+            print('%s: %s %s' % (field, desc['dtype'], desc['shape']))
+        print('classes: ' + ', '.join(['%s: %d' % (k, v) 
+            for k, v in sorted(meta['class_counts'].items())]))
 
 
     def _show_dataset(name, data, n):
@@ -427,3 +1279,60 @@ class OMTFDataset:
         for c, s in data[DSET_STAT_FIELDS.MUON_SIGNATURES]:
             print('pt code: %d sign: %s' % (c, s))
 
+
+# ===== BENCHMARK
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+    import time
+    import tracemalloc
+    from nn4omtf.utils import save_dict_as_npz
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark dataset generation on synthetic files")
+    parser.add_argument('--files', type=int, default=56)
+    parser.add_argument('--events', type=int, default=30000,
+        help='Events per file')
+    parser.add_argument('--train', type=int, default=700000)
+    parser.add_argument('--valid', type=int, default=150000)
+    parser.add_argument('--test', type=int, default=150000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stream', action='store_true',
+        help='Generate into memory-mapped files')
+    parser.add_argument('--block', type=int, default=2**20)
+    parser.add_argument('--jobs', type=int, default=1,
+        help='Number of processes reading source files')
+    FLAGS = parser.parse_args()
+
+    rng = np.random.RandomState(FLAGS.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        print("Writing %d synthetic files..." % FLAGS.files)
+        for i in range(FLAGS.files):
+            code, sign = i // 2 + 1, 'pm'[i % 2]
+            hits = rng.randint(-800, 800, size=(FLAGS.events, 18, 2))
+            hits[rng.rand(FLAGS.events, 18, 2) < 0.9] = 5400
+            path = os.path.join(tmp, 'SingleMu_%s_%d.npz' % (sign, code))
+            save_dict_as_npz(path, **{
+                NPZ_FIELDS.HITS_REDUCED: hits.astype(NPZ_FIELDS.HITS_DTYPE),
+                NPZ_FIELDS.PROD: rng.rand(FLAGS.events, 4).astype(np.float32),
+                NPZ_FIELDS.OMTF: rng.rand(FLAGS.events, 6).astype(np.float32),
+                NPZ_FIELDS.PT_CODE: code,
+                NPZ_FIELDS.SIGN: sign})
+            files.append(path)
+
+        ds = OMTFDataset(files, FLAGS.train, FLAGS.valid, FLAGS.test,
+                block_size=FLAGS.block, seed=FLAGS.seed)
+        outdir = os.path.join(tmp, 'dataset') if FLAGS.stream else None
+        tracemalloc.start()
+        t = time.time()
+        ds.generate(outdir=outdir, jobs=FLAGS.jobs)
+        t = time.time() - t
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        size = sum(arr.nbytes for v in ds.dataset.values() for arr in v.values())
+        print("=" * 10 + " BENCHMARK")
+        print("Generation time: %.2f sec." % t)
+        print("Dataset size: %.1f MB" % (size / 2**20))
+        print("Peak memory: %.1f MB" % (peak / 2**20))
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2018 Jacek Łysiak
+    MIT License
+
+    Cache of generated datasets.
+
+    Each entry is a directory named after hash of source files
+    signatures, dataset generation parameters and cache version:
+        `cache/`
+          |- `<key>/`
+          |    |- `entry.json` - parameters, size, last use time
+          |    |- dataset and statistics files
+          |- ...
+    Files are hard-linked between cache and output directory
+    (copied if it's not possible), so storing and fetching dataset
+    doesn't copy any data.
+    Least recently used entries are removed when total size of cache
+    exceeds given limit.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from nn4omtf.utils import dict_to_json, json_to_dict
+
+
+CACHE_ENTRY = 'entry.json'
+# Increase when generated files layout, fields or dtypes change,
+# entries of older versions are not matched anymore
+CACHE_VERSION = 1
+
+
+def path_size(path):
+    """
+    Get size of file or total size of files in directory.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+def source_signature(path):
+    """
+    Get signature of source file or `*.npy` directory.
+    It changes when source is converted again.
+    Returns:
+        list of [path, size, mtime] for each file
+    """
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return [[path, st.st_size, st.st_mtime_ns]]
+    sig = []
+    for root, _, files in sorted(os.walk(path)):
+        for f in sorted(files):
+            st = os.stat(os.path.join(root, f))
+            sig.append([os.path.join(root, f), st.st_size, st.st_mtime_ns])
+    return sig
+
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def link_path(src, dst):
+    """
+    Hard-link file or directory tree, copy if linking fails.
+    Existing destination is replaced.
+    """
+    remove_path(dst)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=_link)
+    else:
+        _link(src, dst)
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class OMTFDatasetCache:
+    """
+    Content-addressed cache of generated datasets.
+    Key is calculated from source files signatures and generation
+    parameters, see `get_key`. Datasets generated with random seed
+    should not be cached.
+    """
+
+    def __init__(self, path, max_size=None):
+        """
+        Args:
+            path: cache directory
+            max_size: cache size limit in bytes, unlimited if None
+        """
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+
+    def get_key(self, files, **params):
+        """
+        Calculate cache key.
+        Args:
+            files: list of source files
+            params: all parameters which change generated files
+        Returns:
+            key as hex string
+        """
+        sig = {
+            'version': CACHE_VERSION,
+            'sources': [source_signature(f) for f in files],
+            'params': params}
+        s = json.dumps(sig, sort_keys=True)
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+    def get_entry_path(self, key):
+        return os.path.join(self.path, key)
+
+
+    def load_entry(self, key):
+        """
+        Load cache entry description.
+        Returns:
+            dict or None if there's no entry
+        """
+        path = os.path.join(self.get_entry_path(key), CACHE_ENTRY)
+        if not os.path.exists(path):
+            return None
+        return json_to_dict(path)
+
+
+    def fetch(self, key, paths):
+        """
+        Put cached files in place of given output paths.
+        Files are matched by position, names of outputs can differ
+        from names used when entry was stored.
+        Args:
+            key: cache key
+            paths: list of output files or directories
+        Returns:
+            True if all files were found in cache
+        """
+        entry = self.load_entry(key)
+        if entry is None or len(entry['files']) != len(paths):
+            return False
+        entry_path = self.get_entry_path(key)
+        srcs = [os.path.join(entry_path, f) for f in entry['files']]
+        if not all([os.path.exists(src) for src in srcs]):
+            return False
+        for src, dst in zip(srcs, paths):
+            link_path(src, dst)
+        entry['last_used'] = time.time()
+        dict_to_json(os.path.join(entry_path, CACHE_ENTRY), entry)
+        return True
+
+
+    def store(self, key, paths, params=None):
+        """
+        Store output files in cache and evict old entries.
+        Entry of same key is replaced.
+        Args:
+            key: cache key
+            paths: list of output files or directories
+            params: parameters saved in entry description
+        """
+        entry_path = self.get_entry_path(key)
+        tmp_path = entry_path + '.tmp'
+        remove_path(tmp_path)
+        os.makedirs(tmp_path)
+        size = 0
+        for p in paths:
+            link_path(p, os.path.join(tmp_path, os.path.basename(p)))
+            size += path_size(p)
+        entry = {
+            'files': [os.path.basename(p) for p in paths],
+            'params': params,
+            'size': size,
+            'last_used': time.time()}
+        dict_to_json(os.path.join(tmp_path, CACHE_ENTRY), entry)
+        remove_path(entry_path)
+        os.rename(tmp_path, entry_path)
+        self.evict(keep=key)
+
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until cache size
+        is below limit.
+        Args:
+            keep: key of entry which is never removed
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        for key in os.listdir(self.path):
+            entry = self.load_entry(key)
+            if entry is not None:
+                entries.append((entry['last_used'], entry['size'], key))
+        entries.sort()
+        total = sum([size for _, size, _ in entries])
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            print('Removing dataset from cache: %s' % key)
+            remove_path(self.get_entry_path(key))
+            total -= size
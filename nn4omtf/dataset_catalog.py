@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2018 Jacek Łysiak
+    MIT License
+
+    Catalog of converted source files.
+
+    Catalog is built only from scalar fields stored by ROOT-to-numpy
+    converter (`ev_n`, `pt_code`, `sign`, `pt_min`, `pt_max`),
+    HITS arrays are not loaded. It's used to select source files by
+    pt code and sign and to check dataset partition before generation,
+    see `OMTFDataset.dry_run`.
+"""
+
+import numpy as np
+import os
+
+from nn4omtf.const_dataset import NPZ_FIELDS
+from nn4omtf.utils import load_npz_or_npy_dir, load_npz_member_head,\
+    NpyDirFile
+
+
+CATALOG_FIELDS = [NPZ_FIELDS.EV_N, NPZ_FIELDS.PT_CODE, NPZ_FIELDS.SIGN,
+        NPZ_FIELDS.PT_MIN, NPZ_FIELDS.PT_MAX]
+
+
+def is_source_path(path):
+    """
+    Check whether path is converted `*.npz` file or `*.npy` directory.
+    Hidden files (e.g. source file index) are skipped.
+    """
+    if os.path.basename(os.path.normpath(path)).startswith('.'):
+        return False
+    if os.path.isdir(path):
+        return os.path.exists(os.path.join(path,
+            NPZ_FIELDS.HITS_REDUCED + '.npy'))
+    return path.endswith('.npz')
+
+
+def expand_sources(paths):
+    """
+    Get list of source files.
+    Directories which aren't `*.npy` sources are replaced by
+    sources found inside them (not recursively), in name order.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path) and not is_source_path(path):
+            files += [os.path.join(path, f) for f in sorted(os.listdir(path))
+                    if is_source_path(os.path.join(path, f))]
+        else:
+            files.append(path)
+    return files
+
+
+def read_source_meta(fn):
+    """
+    Read scalar fields and HITS shape of single source file.
+    Returns:
+        dict( field name: value ) for fields in `CATALOG_FIELDS`,
+        `path` and `hits_shape` - shape of single event HITS
+    """
+    data = load_npz_or_npy_dir(fn, mmap_mode='r')
+    meta = dict([(k, np.asarray(data[k]).item()) for k in CATALOG_FIELDS])
+    if isinstance(data, NpyDirFile):
+        shape = data[NPZ_FIELDS.HITS_REDUCED].shape[1:]
+    else:
+        shape = load_npz_member_head(fn, NPZ_FIELDS.HITS_REDUCED, 0).shape[1:]
+    data.close()
+    meta[NPZ_FIELDS.PT_CODE] = int(meta[NPZ_FIELDS.PT_CODE])
+    meta[NPZ_FIELDS.SIGN] = str(meta[NPZ_FIELDS.SIGN])
+    meta['path'] = fn
+    meta['hits_shape'] = list(shape)
+    return meta
+
+
+class OMTFSourceCatalog:
+    """
+    Metadata of converted source files.
+    """
+
+    def __init__(self, paths):
+        """
+        Args:
+            paths: source files, `*.npy` directories or directories
+                containing them, see `expand_sources`
+        """
+        self.entries = [read_source_meta(fn) for fn in expand_sources(paths)]
+
+
+    def select(self, pt_codes=None, sign=None):
+        """
+        Select source files.
+        Args:
+            pt_codes: (min, max) - range of pt codes, inclusive
+            sign: muon charge sign, `p` or `m`
+        Returns:
+            list of source files paths
+        """
+        res = []
+        for e in self.entries:
+            code = e[NPZ_FIELDS.PT_CODE]
+            if pt_codes is not None and \
+                    not pt_codes[0] <= code <= pt_codes[1]:
+                continue
+            if sign is not None and e[NPZ_FIELDS.SIGN] != sign:
+                continue
+            res.append(e['path'])
+        return res
+
+
+    def get_entry(self, fn):
+        for e in self.entries:
+            if e['path'] == fn:
+                return e
+        return read_source_meta(fn)
+
+
+    def show(self):
+        print('=' * 10 + ' SOURCE FILES')
+        print("%8s %5s %10s %10s %10s  %s" % ('pt code', 'sign', 'events',
+            'pt min', 'pt max', 'path'))
+        for e in self.entries:
+            print("%8d %5s %10d %10.2f %10.2f  %s" % (e[NPZ_FIELDS.PT_CODE],
+                e[NPZ_FIELDS.SIGN], e[NPZ_FIELDS.EV_N], e[NPZ_FIELDS.PT_MIN],
+                e[NPZ_FIELDS.PT_MAX], e['path']))
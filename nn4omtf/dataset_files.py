@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2018 Jacek Łysiak
+    MIT License
+
+    Dataset files layout.
+
+    Dataset generated with `OMTFDataset` can be stored as:
+    - flat `*.npz` file with single array per phase and field, 
+      named `PHASE/FIELD`, e.g. `TRAIN/HITS`. Uncompressed arrays 
+      are memory-mapped directly from the archive.
+      Old `*.npz` files with pickled dict of fields per phase are still
+      readable.
+    - directory with uncompressed `*.npy` file per phase and field:
+        `dataset/`
+          |- `meta.json` - phases sizes, fields dtypes and shapes
+          |- `TRAIN/HITS.npy`, `TRAIN/PT_VAL.npy`, ...
+          |- `VALID/...`
+          |- `TEST/...`
+      Arrays in directory can be memory-mapped, so dataset doesn't have
+      to fit in memory.
+    - sharded directory, each phase is split into shards of fixed size:
+        `dataset/`
+          |- `meta.json` - as above + shards sizes
+          |- `TRAIN/HITS-00000.npy`, `TRAIN/HITS-00001.npy`, ...
+          |- ...
+      Shards can be read one by one, see `iter_dataset_shards`.
+    Memory-mapped phases can be read in blocks, see `iter_dataset_blocks`.
+
+    Full HITS tensors [18, 14] are optionally stored in sparse form,
+    as two fields of shape [examples, width]: positions in flattened 
+    tensor and values of registered hits, see `sparse_hits_full`.
+    They are densified batch by batch when fed into network.
+
+    `meta.json` manifest contains also number of examples of each class
+    (muon pt code and sign, null examples counted separately) and 
+    dataset generation parameters. Same metadata is saved in header
+    of flat `*.npz` file, see `load_dataset_header`.
+"""
+
+import numpy as np
+import os
+
+from nn4omtf.utils import dict_to_json, json_to_dict, load_npz_member,\
+    save_npz, load_npz_header, load_npz_member_head, cast_checked
+from nn4omtf.const_dataset import DATASET_FIELDS, DATASET_DTYPES,\
+    HITS_FULL_SHAPE, HITS_FULL_PADDING
+from nn4omtf.const_files import COMPRESSION
+
+
+DATASET_META = 'meta.json'
+
+
+def get_npz_key(phase, field):
+    return phase + '/' + field
+
+
+def blocks(n, block_size):
+    """
+    Split range of `n` elements into consecutive blocks.
+    Returns:
+        list of slices
+    """
+    return [slice(b, min(b + block_size, n)) for b in range(0, n, block_size)]
+
+
+def get_field_path(path, phase, field, shard=None):
+    if shard is None:
+        return os.path.join(path, phase, field + '.npy')
+    return os.path.join(path, phase, '%s-%05d.npy' % (field, shard))
+
+
+def create_field_array(path, phase, field, n, shape, dtype, suffix=''):
+    """
+    Create memory-mapped `*.npy` array for dataset field.
+    Args:
+        path: dataset directory
+        phase: dataset phase name
+        field: field name
+        n: number of examples
+        shape: shape of single example
+        dtype: type of array
+        suffix: suffix appended to file name
+    Returns:
+        writable memory-mapped array
+    """
+    os.makedirs(os.path.join(path, phase), exist_ok=True)
+    return np.lib.format.open_memmap(
+            get_field_path(path, phase, field) + suffix, mode='w+',
+            dtype=dtype, shape=(n,) + tuple(shape))
+
+
+def save_dataset_npz(path, dataset, compression=COMPRESSION.NONE, 
+        params=None):
+    """
+    Save dataset as flat `*.npz` file.
+    Arrays stored uncompressed can be memory-mapped.
+    Args:
+        path: dataset file path
+        dataset: dict( phase name: dict( field name: array ) )
+        compression: value from `COMPRESSION`
+        params: dict of generation parameters stored in header
+    """
+    data = dict()
+    header = {'phases': dict(), 'params': params}
+    for phase, fields in dataset.items():
+        header['phases'][phase] = get_phase_meta(fields)
+        for field, arr in fields.items():
+            data[get_npz_key(phase, field)] = arr
+    save_npz(path, compression=compression, header=header, **data)
+
+
+def get_hits_null(transform=None):
+    """
+    Get HITS NULL value, 5400 if data is not transformed.
+    """
+    return 5400 if transform is None else transform[0]
+
+
+def sparse_hits_full(hits, transform=None):
+    """
+    Convert full HITS tensors into sparse form.
+    Registered hits (different than NULL 5400) of each event are 
+    placed at the beginning of row, rows are padded to the largest 
+    number of hits in event.
+    Args:
+        hits: array of shape [n] + `HITS_FULL_SHAPE`
+        transform: (null value, shift value), values are shifted
+    Returns:
+        (positions, values) - arrays of shape [n, width]
+        - positions of hits in flattened tensor, padding is 
+            `HITS_FULL_PADDING[HITS_FULL_POS]`
+        - values of hits, padding is `HITS_FULL_PADDING[HITS_FULL_VAL]`
+    """
+    n = hits.shape[0]
+    flat = np.asarray(hits).reshape(n, -1)
+    mask = flat < 5400
+    nnz = np.sum(mask, axis=1)
+    width = max(int(nnz.max()) if n > 0 else 0, 1)
+    # Stable sort keeps hits in order of positions
+    pos = np.argsort(~mask, axis=1, kind='stable')[:, :width]
+    vals = np.take_along_axis(flat, pos, axis=1).astype(np.int32)
+    if transform is not None:
+        vals += transform[1]
+    pad = np.arange(width) >= nnz[:, None]
+    pos[pad] = HITS_FULL_PADDING[DATASET_FIELDS.HITS_FULL_POS]
+    vals[pad] = HITS_FULL_PADDING[DATASET_FIELDS.HITS_FULL_VAL]
+    return (cast_checked(pos, DATASET_DTYPES[DATASET_FIELDS.HITS_FULL_POS]),
+        cast_checked(vals, DATASET_DTYPES[DATASET_FIELDS.HITS_FULL_VAL]))
+
+
+def pad_sparse(arr, field, width):
+    """
+    Pad sparse HITS field array to given width.
+    """
+    if arr.shape[1] >= width:
+        return arr
+    res = np.full((arr.shape[0], width), HITS_FULL_PADDING[field], 
+            dtype=arr.dtype)
+    res[:, :arr.shape[1]] = arr
+    return res
+
+
+def dense_hits_full(pos, vals, null_value):
+    """
+    Convert sparse full HITS back into dense tensors.
+    Args:
+        pos, vals: see `sparse_hits_full`
+        null_value: value of not registered hits, see `get_hits_null`
+    Returns:
+        array of shape [n] + `HITS_FULL_SHAPE`
+    """
+    n = pos.shape[0]
+    res = np.full((n, int(np.prod(HITS_FULL_SHAPE))), null_value, 
+            dtype=vals.dtype)
+    rows, cols = np.nonzero(pos != HITS_FULL_PADDING[
+        DATASET_FIELDS.HITS_FULL_POS])
+    res[rows, pos[rows, cols]] = vals[rows, cols]
+    return res.reshape([n] + HITS_FULL_SHAPE)
+
+
+def get_class_label(code, sign):
+    return "%s%d" % ('+' if sign > 0 else '-', code)
+
+
+def count_classes(data, block_size=2**20):
+    """
+    Count examples of each class in dataset phase.
+    Args:
+        data: dict( field name: array )
+        block_size: number of examples counted at once
+    Returns:
+        dict( class label: examples number ), `NULL` for null examples
+    """
+    counts = dict()
+    n = data[DATASET_FIELDS.IS_NULL].shape[0]
+    for b in blocks(n, block_size):
+        is_null = np.asarray(data[DATASET_FIELDS.IS_NULL][b])
+        code = np.asarray(data[DATASET_FIELDS.PT_CODE][b])[~is_null]
+        sign = np.asarray(data[DATASET_FIELDS.SIGN][b])[~is_null]
+        counts['NULL'] = counts.get('NULL', 0) + int(np.sum(is_null))
+        pairs, pairs_n = np.unique(np.stack([code, sign > 0]), axis=1, 
+                return_counts=True)
+        for (c, s), k in zip(pairs.T, pairs_n):
+            label = get_class_label(int(c), 1 if s else -1)
+            counts[label] = counts.get(label, 0) + int(k)
+    return counts
+
+
+def get_phase_meta(fields):
+    """
+    Get metadata of dataset phase.
+    Args:
+        fields: dict( field name: array )
+    Returns:
+        dict with number of examples, fields dtypes and shapes 
+        and classes counts
+    """
+    return {
+        'n': int(fields[DATASET_FIELDS.HITS].shape[0]),
+        'fields': dict([(field, {'dtype': arr.dtype.str, 
+            'shape': list(arr.shape[1:])}) for field, arr in fields.items()]),
+        'class_counts': count_classes(fields)}
+
+
+def save_dataset_dir(path, dataset, params=None, shard_size=None):
+    """
+    Save dataset as directory of `*.npy` files.
+    Arrays which are already memory-mapped files in that place are
+    only flushed. If `shard_size` is given, each phase is split into
+    shards of `shard_size` examples, last one may be smaller. 
+    Memory-mapped arrays from that directory are removed after
+    splitting.
+    Args:
+        path: dataset directory
+        dataset: dict( phase name: dict( field name: array ) )
+        params: dict of generation parameters stored in metadata
+        shard_size: number of examples in single shard
+    """
+    meta = {'phases': dict(), 'params': params}
+    if shard_size is not None:
+        meta['shard_size'] = shard_size
+    for phase, fields in dataset.items():
+        n = fields[DATASET_FIELDS.HITS].shape[0]
+        phase_meta = get_phase_meta(fields)
+        if shard_size is not None:
+            phase_meta['shards'] = [s.stop - s.start 
+                    for s in blocks(n, shard_size)]
+        for field, arr in fields.items():
+            fpath = get_field_path(path, phase, field)
+            in_place = isinstance(arr, np.memmap) and \
+                    arr.filename is not None and \
+                    os.path.abspath(arr.filename) == os.path.abspath(fpath)
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            if shard_size is not None:
+                for i, b in enumerate(blocks(n, shard_size)):
+                    np.save(get_field_path(path, phase, field, i), arr[b])
+                if in_place:
+                    os.remove(fpath)
+            elif in_place:
+                arr.flush()
+            else:
+                np.save(fpath, arr)
+        meta['phases'][phase] = phase_meta
+    dict_to_json(os.path.join(path, DATASET_META), meta)
+
+
+def load_dataset_meta(path):
+    """
+    Load dataset directory manifest.
+    """
+    return json_to_dict(os.path.join(path, DATASET_META))
+
+
+def load_dataset_header(path):
+    """
+    Load dataset metadata without touching arrays.
+    Args:
+        path: dataset file or directory
+    Returns:
+        dict as in `meta.json`, None for `*.npz` files without header
+    """
+    if os.path.isdir(path):
+        return load_dataset_meta(path)
+    header = load_npz_header(path)
+    if header is None or 'phases' not in header:
+        return None
+    return header
+
+
+def load_dataset_head(path, phase, n):
+    """
+    Load first `n` examples of dataset phase.
+    Only beginning of each array is read (and decompressed).
+    Args:
+        path: dataset file or directory
+        phase: phase name, value from `DATASET_TYPES`
+        n: number of examples
+    Returns:
+        dict( field name: array )
+    """
+    if os.path.isdir(path):
+        data = next(iter_dataset_shards(path, phase))
+        return dict([(f, np.array(arr[:n])) for f, arr in data.items()])
+    header = load_dataset_header(path)
+    if header is None:
+        data = load_dataset_phase(path, phase, mmap_mode=None)
+        return dict([(f, arr[:n]) for f, arr in data.items()])
+    return dict([(f, load_npz_member_head(path, get_npz_key(phase, f), n))
+        for f in header['phases'][phase]['fields']])
+
+
+def get_dataset_hits_null(path):
+    """
+    Get HITS NULL value of dataset, taken from generation parameters.
+    """
+    header = load_dataset_header(path)
+    params = None if header is None else header.get('params')
+    return get_hits_null(None if not params else params.get('transform'))
+
+
+def is_sharded(path):
+    """
+    Check whether given path is sharded dataset directory.
+    """
+    return os.path.isdir(path) and 'shard_size' in load_dataset_meta(path)
+
+
+def iter_dataset_shards(path, phase, fields=None, mmap_mode='r'):
+    """
+    Iterate over shards of single dataset phase.
+    `*.npz` files and not sharded directories give single shard.
+    Args:
+        path: dataset file or directory
+        phase: phase name, value from `DATASET_TYPES`
+        fields: list of fields to load, all if None
+        mmap_mode: memory-map mode used for dataset directories
+    Returns:
+        generator of dicts( field name: array )
+    """
+    if not is_sharded(path):
+        yield load_dataset_phase(path, phase, fields, mmap_mode=mmap_mode)
+        return
+    phase_meta = load_dataset_meta(path)['phases'][phase]
+    if fields is None:
+        fields = list(phase_meta['fields'].keys())
+    for i in range(len(phase_meta['shards'])):
+        yield dict([(f, np.load(get_field_path(path, phase, f, i),
+            mmap_mode=mmap_mode)) for f in fields])
+
+
+def iter_dataset_blocks(path, phase, block_size, fields=None):
+    """
+    Iterate over contiguous blocks of single dataset phase.
+    Arrays are memory-mapped (uncompressed `*.npz` files, dataset
+    directories and shards), so only current block is read into memory.
+    Compressed `*.npz` arrays are read whole. Blocks don't cross shards.
+    Args:
+        path: dataset file or directory
+        phase: phase name, value from `DATASET_TYPES`
+        block_size: number of examples in block
+        fields: list of fields to load, all if None
+    Returns:
+        generator of dicts( field name: array in memory )
+    """
+    for shard in iter_dataset_shards(path, phase, fields, mmap_mode='r'):
+        n = next(iter(shard.values())).shape[0]
+        for b in blocks(n, block_size):
+            yield dict([(f, np.array(arr[b])) for f, arr in shard.items()])
+
+
+def take_dataset_rows(shards, idx):
+    """
+    Gather examples of dataset phase stored in shards.
+    Memory-mapped arrays are read in ascending order of indices,
+    only gathered examples are read into memory.
+    Args:
+        shards: list of dicts( field name: array ),
+            see `iter_dataset_shards`
+        idx: indices of examples in whole phase
+    Returns:
+        dict( field name: array ) of examples in `idx` order
+    """
+    order = np.argsort(idx, kind='stable')
+    sorted_idx = idx[order]
+    lens = [next(iter(s.values())).shape[0] for s in shards]
+    ends = np.cumsum(lens)
+    begins = ends - lens
+    # Indices of examples in each shard
+    parts = np.split(sorted_idx, np.searchsorted(sorted_idx, ends[:-1]))
+    res = dict()
+    for f, arr in shards[0].items():
+        out = np.empty((idx.shape[0],) + arr.shape[1:], dtype=arr.dtype)
+        out[order] = np.concatenate([s[f][p - b]
+            for s, p, b in zip(shards, parts, begins)])
+        res[f] = out
+    return res
+
+
+def load_dataset_phase(path, phase, fields=None, mmap_mode='r'):
+    """
+    Load fields of single dataset phase.
+    Works with both `*.npz` files and dataset directories.
+    Shards are loaded one by one and concatenated.
+    Args:
+        path: dataset file or directory
+        phase: phase name, value from `DATASET_TYPES`
+        fields: list of fields to load, all if None
+        mmap_mode: memory-map mode used for dataset directories
+    Returns:
+        dict( field name: array )
+    """
+    if not os.path.isdir(path):
+        with np.load(path) as npz:
+            files = npz.files
+        if phase in files:
+            # Old format, pickled dict of fields
+            with np.load(path, allow_pickle=True) as npz:
+                data = npz[phase].item()
+            if fields is None:
+                return data
+            return dict([(f, data[f]) for f in fields])
+        prefix = get_npz_key(phase, '')
+        if fields is None:
+            fields = [k[len(prefix):] for k in files if k.startswith(prefix)]
+        return dict([(f, load_npz_member(path, get_npz_key(phase, f), 
+            mmap_mode=mmap_mode)) for f in fields])
+
+    meta = load_dataset_meta(path)
+    phase_meta = meta['phases'][phase]
+    if fields is None:
+        fields = list(phase_meta['fields'].keys())
+    if 'shards' in phase_meta:
+        shards = list(iter_dataset_shards(path, phase, fields, mmap_mode))
+        return dict([(f, np.concatenate([s[f] for s in shards])) 
+            for f in fields])
+    return dict([(f, np.load(get_field_path(path, phase, f),
+        mmap_mode=mmap_mode)) for f in fields])
+
+
+def get_dataset_phases(path):
+    """
+    Get list of phases stored in dataset file or directory.
+    """
+    header = load_dataset_header(path)
+    if header is not None:
+        return list(header['phases'].keys())
+    with np.load(path) as npz:
+        phases = [k.split('/')[0] for k in npz.files]
+    return sorted(set(phases), key=phases.index)
+
+
+# ===== BENCHMARK
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+    import time
+    from nn4omtf.const_dataset import DATASET_TYPES
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark dataset file compression on synthetic data")
+    parser.add_argument('--examples', type=int, default=1000000,
+        help='Number of TRAIN examples')
+    parser.add_argument('--seed', type=int, default=0)
+    FLAGS = parser.parse_args()
+
+    n = FLAGS.examples
+    rng = np.random.RandomState(FLAGS.seed)
+    # Transformed HITS: most of hits are NULL (0), others shifted by 600
+    hits = rng.randint(-200, 1400, size=(n, 18, 2))
+    hits[rng.rand(n, 18, 2) < 0.9] = 0
+    fields = {
+        DATASET_FIELDS.HITS: hits,
+        DATASET_FIELDS.PT_VAL: rng.exponential(20., size=n),
+        DATASET_FIELDS.SIGN: rng.choice([-1, 1], size=n),
+        DATASET_FIELDS.IS_NULL: rng.rand(n) < 0.05,
+        DATASET_FIELDS.PT_CODE: rng.randint(1, 32, size=n)}
+    dataset = {DATASET_TYPES.TRAIN: dict([(k, v.astype(DATASET_DTYPES[k])) 
+        for k, v in fields.items()])}
+    raw = sum(arr.nbytes for arr in dataset[DATASET_TYPES.TRAIN].values())
+
+    print("=" * 10 + " BENCHMARK")
+    print("TRAIN examples: %d, raw size: %.1f MB" % (n, raw / 2**20))
+    print("%-6s %10s %10s %10s %10s" % ('codec', 'write s', 'read s', 
+        'mmap s', 'size MB'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for codec in [COMPRESSION.NONE, COMPRESSION.FAST, COMPRESSION.MAX]:
+            path = os.path.join(tmp, codec + '.npz')
+            t = time.time()
+            save_dataset_npz(path, dataset, compression=codec)
+            t_write = time.time() - t
+            t = time.time()
+            data = load_dataset_phase(path, DATASET_TYPES.TRAIN, 
+                    mmap_mode=None)
+            t_read = time.time() - t
+            t = time.time()
+            data = load_dataset_phase(path, DATASET_TYPES.TRAIN, 
+                    fields=[DATASET_FIELDS.HITS])
+            hits_sum = int(np.sum(data[DATASET_FIELDS.HITS], dtype=np.int64))
+            t_mmap = time.time() - t
+            del data
+            print("%-6s %10.2f %10.2f %10.2f %10.1f" % (codec, t_write, 
+                t_read, t_mmap, os.path.getsize(path) / 2**20))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2018 Jacek Łysiak
+    MIT License
+
+    Sidecar index of converted source files.
+
+    Good/null selection and input histograms depend only on per-event
+    HITS sums and distinct HITS values, so they are calculated once
+    and stored next to source file:
+        `conv/`
+          |- `SingleMu_p_1.npz` - converted file (or `*.npy` directory)
+          |- `.SingleMu_p_1.npz.index.npz` - its index
+    Hidden file is not matched by `*.npz` wildcard of source files.
+    Index is built on first use and rebuilt if source file size or
+    modification time changed. If index can't be written (e.g. read-only
+    directory), it's built in memory on each use.
+
+    Events are sorted by HITS mean, so good events for any threshold
+    are a prefix of that order, found with binary search.
+    Means are kept as exact integer sums, so selection gives exactly
+    same events as `hits_avg < treshold`.
+"""
+
+import numpy as np
+import os
+
+from nn4omtf.const_dataset import NPZ_DATASET, NPZ_INDEX
+from nn4omtf.const_files import COMPRESSION
+from nn4omtf.dataset_cache import source_signature
+from nn4omtf.utils import load_npz_or_npy_dir, int_value_counts, save_npz,\
+    load_npz_header, cast_checked
+
+
+INDEX_SUFFIX = '.index.npz'
+# Increase when index content changes
+INDEX_VERSION = 1
+# HITS values from this one up are NULL
+HITS_NULL = 5400
+
+
+def get_index_path(fn):
+    """
+    Get path of index of `*.npz` file or `*.npy` directory.
+    """
+    fn = os.path.normpath(fn)
+    head, tail = os.path.split(fn)
+    return os.path.join(head, '.' + tail + INDEX_SUFFIX)
+
+
+def get_source_stamp(fn):
+    """
+    Get sizes and modification times of source files, index is valid
+    while they are unchanged.
+    """
+    return [s[1:] for s in source_signature(fn)]
+
+
+def build_index(hits, code, sign):
+    """
+    Build index of single source file.
+    Args:
+        hits: HITS array of integer type
+        code: muon pt code
+        sign: muon charge sign
+    Returns:
+        dict of index arrays, see `NPZ_INDEX`
+    """
+    sums = np.sum(hits, axis=(1,2), dtype=np.int64)
+    null = hits >= HITS_NULL
+    null_n = np.sum(null, axis=(1,2))
+    valid_sums = np.sum(np.where(null, 0, hits), axis=(1,2), dtype=np.int64)
+    vals, vals_n = int_value_counts(hits)
+    return {
+        NPZ_INDEX.EV_N: np.int64(hits.shape[0]),
+        NPZ_INDEX.HITS_SIZE: np.int64(np.prod(hits.shape[1:])),
+        NPZ_INDEX.SUMS: cast_checked(sums, np.int32),
+        NPZ_INDEX.ORDER: np.argsort(sums, kind='stable').astype(np.int32),
+        NPZ_INDEX.NULL_N: null_n.astype(np.uint16),
+        NPZ_INDEX.VALID_SUMS: cast_checked(valid_sums, np.int32),
+        NPZ_INDEX.VALS: vals,
+        NPZ_INDEX.VALS_N: vals_n,
+        NPZ_INDEX.PT_CODE: np.asarray(code),
+        NPZ_INDEX.SIGN: np.asarray(sign)}
+
+
+def save_index(fn, index):
+    """
+    Save index of source file, it's written into temporary file first,
+    so readers never see partial index.
+    """
+    path = get_index_path(fn)
+    tmp = '%s.%d.tmp.npz' % (path[:-len('.npz')], os.getpid())
+    header = {'version': INDEX_VERSION, 'source': get_source_stamp(fn)}
+    save_npz(tmp, COMPRESSION.NONE, header=header, **index)
+    os.replace(tmp, path)
+
+
+def is_index_valid(fn):
+    path = get_index_path(fn)
+    if not os.path.exists(path):
+        return False
+    header = load_npz_header(path)
+    return header is not None and \
+        header.get('version') == INDEX_VERSION and \
+        header.get('source') == get_source_stamp(fn)
+
+
+def load_index(fn, hits=None, save=True):
+    """
+    Load index of source file, build it if it's missing or outdated.
+    Args:
+        fn: path to `*.npz` file or `*.npy` directory
+        hits: HITS array of file if it's already read,
+            it's used if index must be built
+        save: save built index next to source file
+    Returns:
+        dict of index arrays, see `NPZ_INDEX`
+    """
+    if is_index_valid(fn):
+        with np.load(get_index_path(fn)) as data:
+            return dict([(k, data[k]) for k in data.files])
+    print('Building index of: %s' % fn)
+    data = load_npz_or_npy_dir(fn, mmap_mode='r')
+    if hits is None:
+        hits = data[NPZ_DATASET.HITS_REDUCED]
+    index = build_index(hits, data[NPZ_DATASET.PT_CODE],
+            data[NPZ_DATASET.SIGN])
+    data.close()
+    if save:
+        try:
+            save_index(fn, index)
+        except OSError as e:
+            print('Index not saved: %s' % e)
+    return index
+
+
+def index_means(index):
+    """
+    Get HITS means of events in index order, they are sorted.
+    """
+    return index[NPZ_INDEX.SUMS][index[NPZ_INDEX.ORDER]] / \
+        index[NPZ_INDEX.HITS_SIZE]
+
+
+def index_count(index, treshold):
+    """
+    Get number of good (mean < treshold) and null events.
+    Returns:
+        (good events n, null events n)
+    """
+    good_n = int(np.searchsorted(index_means(index), treshold, side='left'))
+    return good_n, int(index[NPZ_INDEX.EV_N]) - good_n
+
+
+def index_select(index, treshold):
+    """
+    Get indices of good (mean < treshold) and null events.
+    Returns:
+        (good events indices, null events indices), both in file order
+    """
+    good_n, _ = index_count(index, treshold)
+    order = index[NPZ_INDEX.ORDER]
+    return np.sort(order[:good_n]), np.sort(order[good_n:])
+
+
+# ===== TEST
+
+if __name__ == '__main__':
+    # Source file without events gives empty index, nothing is selected
+    hits = np.zeros((0, 18, 2), dtype=np.int16)
+    index = build_index(hits, 1, 'p')
+    assert index[NPZ_INDEX.EV_N] == 0
+    assert index[NPZ_INDEX.HITS_SIZE] == 36
+    assert index[NPZ_INDEX.ORDER].shape == (0,)
+    assert index_count(index, 5400.) == (0, 0)
+    good, null = index_select(index, 5400.)
+    assert good.shape == (0,) and null.shape == (0,)
+
+    rng = np.random.RandomState(0)
+    hits = rng.randint(-800, 800, size=(1000, 18, 2)).astype(np.int16)
+    hits[rng.rand(1000, 18, 2) < 0.8] = HITS_NULL
+    index = build_index(hits, 1, 'p')
+    hits_avg = np.mean(hits, axis=(1,2))
+    for treshold in [-100., 0., 3000.5, 4000., 5400., 6000.]:
+        good, null = index_select(index, treshold)
+        assert np.array_equal(good, np.flatnonzero(hits_avg < treshold))
+        assert np.array_equal(null, np.flatnonzero(hits_avg >= treshold))
+    print('Index test passed')
@@ -13,10 +13,11 @@ import tensorflow as tf
 import os
 from nn4omtf.utils import dict_to_object, get_source_of_obj, json_to_dict,\
         dict_to_json, import_module_from_path, get_from_module_by_name,\
-        dict_to_json_string
+        dict_to_json_string, save_npz
 from nn4omtf.model_config import model_data_default, model_hparams_keys,\
         model_config_keys, model_config_keys_datasets 
 from nn4omtf.const_model import MODEL_RESULTS
+from nn4omtf.const_files import COMPRESSION
 from nn4omtf import OMTFStatistics
 
 class OMTFModel:
@@ -262,7 +263,8 @@ class OMTFModel:
         print("Model saved!")
 
 
-    def save_test_results(self, results, suffix=None, note=''):
+    def save_test_results(self, results, suffix=None, note='', 
+            compression=COMPRESSION.FAST):
         path = self.paths.dir_testouts
         name = '{:%Y-%m-%d-%H-%M-%S}'.format(datetime.datetime.now()) 
         if suffix is not None and suffix != '':
@@ -273,9 +275,9 @@ class OMTFModel:
             MODEL_RESULTS.RESULTS: results,
             MODEL_RESULTS.PT_BINS: self.pt_bins,
         }
-        np.savez_compressed(path, **data)
+        save_npz(path, compression=compression, **data)
         with OMTFStatistics(self.get_dataset_paths().ds_test, path + '.npz') as stats:
-            stats.save(path + '-stats')
+            stats.save(path + '-stats', compression=compression)
 
 
     def _update_model_data_with_opts(self, **opts):
@@ -9,7 +9,27 @@
 import tensorflow as tf
 import numpy as np
 import multiprocessing
-from nn4omtf.const_dataset import DATASET_TYPES, DATASET_FIELDS
+from nn4omtf.const_dataset import DATASET_TYPES, DATASET_FIELDS,\
+    HITS_FULL_SHAPE, HITS_FULL_PADDING
+from nn4omtf.dataset_files import load_dataset_phase, load_dataset_header,\
+    iter_dataset_blocks, is_sharded, get_dataset_hits_null
+from nn4omtf.utils import prefetch_iter
+
+
+def float_order_key(x):
+    """
+    Map float tensor onto integers of the same order.
+    Bits of float are taken as integer, negative values are mirrored.
+    CPU float kernels flush subnormal values to zero, integer ops 
+    keep them.
+    Args:
+        x: float32 or float64 tensor
+    Returns:
+        int32 or int64 tensor
+    """
+    itype = tf.int32 if x.dtype == tf.float32 else tf.int64
+    i = tf.bitcast(x, itype)
+    return tf.where(i >= 0, i, -tf.bitwise.bitwise_and(i, itype.max))
 
 
 class OMTFInputPipe:
@@ -22,10 +42,12 @@ class OMTFInputPipe:
     # Loading big dataset from file
 
     In case of not so big datasets whole file is loaded into memory.
-    Eventualy, tf.Dataset can use generators which may load data in
-    smaller portions. It can be implemented with `mmap_mode` in `np.load`
-    method.
-    TODO: Implement feeder using `Dataset.from_generator`
+    If `stream` is set, phase is streamed from disk using 
+    `Dataset.from_generator`: memory-mapped arrays (uncompressed `*.npz`
+    file or dataset directory) or shards are read in contiguous blocks 
+    of `block_size` examples and next block is read in background thread.
+    Only few blocks are kept in memory, so phase can be bigger than memory.
+    Sharded datasets (see `nn4omtf.dataset_files`) are always streamed.
     
     # Mapping pt value onto classes
     
@@ -41,6 +63,15 @@ class OMTFInputPipe:
     - `2k-1` if muon has negative charge sign
     - `0` if muon doesn't have enough data to be classified correctly
 
+    Classes are calculated on whole batches with native graph ops,
+    see `pt_class`.
+
+    # Full HITS tensors
+
+    If `hits_full` is set, network input are full HITS tensors 
+    [18, 14] instead of reduced ones. They are stored in dataset in 
+    sparse form and densified batch by batch in the pipe.
+
     # TEST dataset additional data 
     
     Data labels are created by hand to fix data order in tuple.
@@ -55,7 +86,8 @@ class OMTFInputPipe:
     """
 
     def __init__(self, npz_path, dataset_type, pt_bins, batch_size=1,
-            apply_is_null=True):
+            apply_is_null=True, hits_full=False, stream=False, 
+            block_size=2**18):
         """
         Create input pipe and load data from `*.npz` dataset.
         Args:
@@ -64,6 +96,12 @@ class OMTFInputPipe:
             pt_bins: muon pt classe bins' edges list
             batch_size: size of batch
             apply_is_null: set muon class to 0 if `is_null` arr element is null
+            hits_full: feed full HITS tensors, dataset must be generated
+                with `hits_full` option
+            stream: stream examples from disk instead of loading whole
+                phase into memory
+            block_size: number of examples read from disk at once
+                in stream mode
         """
         types = [v for k, v in vars(DATASET_TYPES).items() if not k.startswith('_')]
         assert dataset_type in types, dataset_type + ' is not valid dataset type!'
@@ -74,24 +112,40 @@ class OMTFInputPipe:
         self.pt_bins = pt_bins
         self.class_n = 2 * len(pt_bins) + 1
         self.path = npz_path
+        self.hits_full = hits_full
+        self.block_size = block_size
         self.data_labels = [
             DATASET_FIELDS.HITS,
             DATASET_FIELDS.PT_VAL,
             DATASET_FIELDS.SIGN,
             DATASET_FIELDS.IS_NULL]
+        if hits_full:
+            self.data_labels = [
+                DATASET_FIELDS.HITS_FULL_POS,
+                DATASET_FIELDS.HITS_FULL_VAL] + self.data_labels[1:]
+            self.hits_null = get_dataset_hits_null(npz_path)
 
-        print('Loading `%s` data from `%s`...' % (dataset_type, npz_path))
-        self.dataset_file = np.load(npz_path)
-        self.dataset = self.dataset_file[dataset_type].item()
-
-        self.iterator = self.build_pipe(dataset_type, **self.dataset)
+        self.stream = stream or is_sharded(npz_path)
+        if self.stream and load_dataset_header(npz_path) is None:
+            print('Old dataset file format, it can\'t be streamed')
+            self.stream = False
+        if self.stream:
+            print('Streaming `%s` data from `%s`...' % (dataset_type, npz_path))
+            self.dataset = None
+            self.iterator = self.build_pipe(dataset_type)
+        else:
+            print('Loading `%s` data from `%s`...' % (dataset_type, npz_path))
+            # Works with `*.npz` file and dataset directory
+            self.dataset = load_dataset_phase(npz_path, dataset_type, 
+                    fields=self.data_labels)
+            self.iterator = self.build_pipe(dataset_type, **self.dataset)
         self.initializer = self.iterator.initializer
         self.next_op = self.iterator.get_next()
         self.session = None
 
 
     def close(self):
-        self.dataset_file.close()
+        self.dataset = None
 
 
     def build_pipe(self, dataset_type, **kw):
@@ -99,45 +153,138 @@ class OMTFInputPipe:
         Build input pipe.
         Args:
             dataset_type: value from `DATASET_TYPES`
-            kw: entries from given type of dataset
+            kw: entries from given type of dataset, 
+                if empty, data is streamed from disk
         Returns:
             dataset iterator
         """
         cores_count = max(multiprocessing.cpu_count() // 4, 1)
 
-        def get_pt_class(pv, sign, is_null):
-            """
-            Helper function calculating correct muon class.
-            """
-            c = np.digitize(pv, self.pt_bins)
-            c = np.where(sign > 0, 2 * c, 2 * c - 1)
-            if self.apply_is_null:
-                c = np.where(is_null, 0, c)
-            return c.astype(np.int32)
-
-        pt_to_class_fn = lambda p, s, n:  tf.py_func(get_pt_class,
-                [p, s, n],
-                tf.int32,
-                stateful=False,
-                name='pt_class')
-
-        map_fn = lambda h, p, s, n: (h, pt_to_class_fn(p, s, n))
+        # HITS are stored as integers, network takes float32 input
+        # Whole batches are mapped, so full HITS are densified per batch
+        map_fn = lambda h, p, s, n: (tf.cast(h, tf.float32), 
+                self.pt_class(p, s, n))
+        if self.hits_full:
+            map_fn = lambda hp, hv, p, s, n: (self.dense_hits_full(hp, hv),
+                    self.pt_class(p, s, n))
         
         with tf.device('/cpu:0'):
             with tf.name_scope('pipe-' + dataset_type.lower()):
-                datasets = [tf.data.Dataset.from_tensor_slices(kw[k]) 
-                        for k in self.data_labels]
-                dataset = tf.data.Dataset.zip(tuple(datasets))
-                # Batch elements before map to hide function call overhead
-                dataset = dataset.batch(10000)
-                dataset = dataset.map(map_func=map_fn, num_parallel_calls=None)
-                dataset = dataset.apply(tf.contrib.data.unbatch())
-                dataset = dataset.prefetch(buffer_size=4*self.batch_size)
-                dataset = dataset.batch(self.batch_size)
+                if kw:
+                    datasets = [tf.data.Dataset.from_tensor_slices(kw[k]) 
+                            for k in self.data_labels]
+                    dataset = tf.data.Dataset.zip(tuple(datasets))
+                    dataset = dataset.batch(self.batch_size)
+                else:
+                    dataset = self.stream_dataset(dataset_type, 
+                            self.batch_size)
+                dataset = dataset.map(map_func=map_fn, 
+                        num_parallel_calls=cores_count)
+                dataset = dataset.prefetch(buffer_size=4)
                 iterator = dataset.make_initializable_iterator()
         return iterator
 
 
+    def pt_class(self, pt, sign, is_null):
+        """
+        Calculate muon classes with native graph ops.
+        Bin of pt is number of `pt_bins` edges not greater than pt, 
+        like `np.digitize`. Edges are rounded up to nearest pt value
+        of pt type and values are compared as ordered integers, 
+        see `float_order_key`, so pt values at and next to edges 
+        are classified exactly as by numpy.
+        Args:
+            pt: muon pt values, [batch]
+            sign: muon charge signs, [batch]
+            is_null: null example flags, [batch]
+        Returns:
+            int32 tensor of classes, [batch]
+        """
+        edges = np.array(self.pt_bins, dtype=np.float64)
+        bins = edges.astype(pt.dtype.as_numpy_dtype)
+        up = bins < edges
+        bins[up] = np.nextafter(bins[up], bins.dtype.type(np.inf))
+        bins = float_order_key(tf.constant(bins))
+        pt = tf.expand_dims(float_order_key(pt), -1)
+        c = tf.reduce_sum(tf.cast(tf.greater_equal(pt, bins), tf.int32), 
+                axis=-1)
+        c = tf.where(tf.greater(sign, 0), 2 * c, 2 * c - 1)
+        if self.apply_is_null:
+            c = tf.where(is_null, tf.zeros_like(c), c)
+        return c
+
+
+    def dense_hits_full(self, pos, vals):
+        """
+        Densify batch of sparse full HITS tensors, 
+        see `nn4omtf.dataset_files.dense_hits_full`.
+        Args:
+            pos: positions of hits, [batch, width]
+            vals: values of hits, [batch, width]
+        Returns:
+            float32 tensor [batch] + `HITS_FULL_SHAPE`
+        """
+        pos = tf.cast(pos, tf.int64)
+        vals = tf.cast(vals, tf.float32)
+        mask = tf.not_equal(pos, 
+                HITS_FULL_PADDING[DATASET_FIELDS.HITS_FULL_POS])
+        rows = tf.where(mask)[:, 0]
+        idx = tf.stack([rows, tf.boolean_mask(pos, mask)], axis=1)
+        # Hits are scattered onto zeros, so NULL is subtracted first
+        updates = tf.boolean_mask(vals, mask) - self.hits_null
+        shape = tf.stack([tf.shape(pos, out_type=tf.int64)[0], 
+            int(np.prod(HITS_FULL_SHAPE))])
+        dense = tf.scatter_nd(idx, updates, shape) + self.hits_null
+        return tf.reshape(dense, [-1] + HITS_FULL_SHAPE)
+
+
+    def stream_dataset(self, dataset_type, batch_size):
+        """
+        Create dataset streaming phase from disk.
+        Phase is read in blocks of `self.block_size` examples, see
+        `nn4omtf.dataset_files.iter_dataset_blocks`. Next block is read
+        in background thread while current one is split into batches.
+        Args:
+            dataset_type: value from `DATASET_TYPES`
+            batch_size: number of examples in single batch
+        Returns:
+            tf.data.Dataset of batches
+        """
+        header = load_dataset_header(self.path)
+        fields = header['phases'][dataset_type]['fields']
+        types = tuple([tf.as_dtype(np.dtype(fields[k]['dtype'])) 
+            for k in self.data_labels])
+        shapes = tuple([tf.TensorShape([None] + fields[k]['shape']) 
+            for k in self.data_labels])
+
+        def gen():
+            # Batches are continued across blocks, only last one can be
+            # smaller than `batch_size`
+            rest = None
+            for block in prefetch_iter(iter_dataset_blocks(self.path, 
+                    dataset_type, self.block_size, fields=self.data_labels)):
+                arrs = [block[k] for k in self.data_labels]
+                n = arrs[0].shape[0]
+                start = 0
+                if rest is not None:
+                    start = min(batch_size - rest[0].shape[0], n)
+                    rest = [np.concatenate([r, a[:start]]) 
+                            for r, a in zip(rest, arrs)]
+                    if rest[0].shape[0] < batch_size:
+                        continue
+                    yield tuple(rest)
+                    rest = None
+                end = start + (n - start) // batch_size * batch_size
+                for b in range(start, end, batch_size):
+                    yield tuple([a[b:b + batch_size] for a in arrs])
+                if end < n:
+                    rest = [a[end:] for a in arrs]
+            if rest is not None:
+                yield tuple(rest)
+
+        return tf.data.Dataset.from_generator(gen, types, shapes)
+
+
     def initialize(self, session):
         """
         Initialize input pipe.
@@ -166,11 +313,21 @@ class OMTFInputPipe:
 
 if __name__ == '__main__':
     import argparse
+    import time
     parser = argparse.ArgumentParser(description="Input pipe test")
     parser.add_argument('--examples', type=int, default=5, 
         help='Number of examples to fetch')
     parser.add_argument('--batch_size', type=int, default=1)
     parser.add_argument('--dont_apply_is_null', action="store_false")
+    parser.add_argument('--stream', action="store_true")
+    parser.add_argument('--benchmark', type=int, metavar='N',
+        help='Measure throughput over N batches, batches are not printed')
+    parser.add_argument('--py_func', action="store_true",
+        help='Calculate classes with numpy in `tf.py_func`, '
+            'as before native ops, to compare throughput')
+    parser.add_argument('--check', action="store_true",
+        help='Compare native classes with numpy ones for pt values '
+            'at, next to and between bins edges')
     parser.add_argument('type', choices=['TRAIN', 'VALID', 'TEST'])
     parser.add_argument('dataset_file')
     parser.add_argument('pt_bins', nargs='+', type=float)
@@ -178,14 +335,62 @@ if __name__ == '__main__':
     FLAGS = parser.parse_args()
     print(FLAGS)
 
+    def get_pt_class(pv, sign, is_null, pt_bins, apply_is_null):
+        c = np.digitize(pv, pt_bins)
+        c = np.where(sign > 0, 2 * c, 2 * c - 1)
+        if apply_is_null:
+            c = np.where(is_null, 0, c)
+        return c.astype(np.int32)
+
+    if FLAGS.check:
+        rng = np.random.RandomState(0)
+        for dtype in [np.float32, np.float64]:
+            edges = np.array(FLAGS.pt_bins, dtype=dtype)
+            tiny = np.finfo(dtype).tiny
+            pt = np.concatenate([edges, np.nextafter(edges, -np.inf), 
+                np.nextafter(edges, np.inf), [-1, -0., tiny, -tiny, 
+                -tiny / 2, np.inf], rng.rand(100000) * 1.2 * 
+                FLAGS.pt_bins[-1] - 1]).astype(dtype)
+            sign = rng.choice(np.array([-1, 1], dtype=np.int8), pt.shape[0])
+            is_null = rng.rand(pt.shape[0]) < 0.2
+            cls = OMTFInputPipe.pt_class(argparse.Namespace(
+                pt_bins=FLAGS.pt_bins, apply_is_null=FLAGS.dont_apply_is_null),
+                tf.constant(pt), tf.constant(sign), tf.constant(is_null))
+            with tf.Session() as sess:
+                cls = sess.run(cls)
+            ref = get_pt_class(pt, sign, is_null, FLAGS.pt_bins, 
+                    FLAGS.dont_apply_is_null)
+            assert np.array_equal(cls, ref), "Classes of %s differ!" % \
+                    pt[cls != ref][:10]
+        print('Native classes are equal to numpy ones')
+
+    if FLAGS.py_func:
+        def pt_class_np(self, pt, sign, is_null):
+            return tf.py_func(lambda p, s, n: get_pt_class(p, s, n, 
+                self.pt_bins, self.apply_is_null), [pt, sign, is_null], 
+                tf.int32, stateful=False, name='pt_class')
+        OMTFInputPipe.pt_class = pt_class_np
+
     pipe = OMTFInputPipe(FLAGS.dataset_file, FLAGS.type, FLAGS.pt_bins,
-            batch_size=FLAGS.batch_size, apply_is_null=FLAGS.dont_apply_is_null)
+            batch_size=FLAGS.batch_size, apply_is_null=FLAGS.dont_apply_is_null,
+            stream=FLAGS.stream)
     with tf.Session() as sess:
         pipe.initialize(sess)
-        for _ in range(FLAGS.examples):
-            data = pipe.fetch()
-            print(data)
+        if FLAGS.benchmark is None:
+            for _ in range(FLAGS.examples):
+                data = pipe.fetch()
+                print(data)
+        else:
+            # First batch fills prefetch buffers, it's not measured
+            pipe.fetch()
+            n = 0
+            t = time.time()
+            for _ in range(FLAGS.benchmark):
+                data = pipe.fetch()
+                if data is None:
+                    break
+                n += data[1].shape[0]
+            t = time.time() - t
+            print('%d examples in %.3f s: %.0f examples/s' % (n, t, n / t))
     
     pipe.close()
-    
-
@@ -10,6 +10,7 @@ import numpy as np
 import os
 import warnings
 from .plotters import PLOTTERS_TABLE, PLOTTER_DEFAULTS
+from .utils import load_npz_header
 import matplotlib.pyplot as plt
 
 
@@ -60,6 +61,22 @@ class OMTFPlotter:
         files = self.data_file.files
         plottable = [f for f in files if f in PLOTTERS_TABLE.keys()]
         return plottable
+
+
+    def get_file_plottables(file_path):
+        """
+        Get list of plottable data in file without opening plotter.
+        Names are taken from file header if it exists, no array is read.
+        Returns:
+            list of plottable element's names
+        """
+        header = load_npz_header(file_path)
+        if header is None:
+            with np.load(file_path) as npz:
+                files = npz.files
+        else:
+            files = list(header['arrays'].keys())
+        return [f for f in files if f in PLOTTERS_TABLE.keys()]
     
 
     def set_outdir(self, outdir=None):
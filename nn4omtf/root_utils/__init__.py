@@ -1 +1,5 @@
-from nn4omtf.root_utils.root_to_np import load_root_dict, root_to_numpy
+from nn4omtf.root_utils.root_to_np import load_root_dict, root_to_numpy,\
+    root_to_numpy_chunked, convert_root_dir, get_output_path, \
+    CONVERTER_VERSION, ROOT_FILE_NAME
+from nn4omtf.root_utils.manifest import load_manifest, save_manifest,\
+    is_up_to_date, update_manifest
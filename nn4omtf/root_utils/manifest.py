@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2018 Jacek Łysiak
+    MIT license
+
+    Conversion manifest.
+    Manifest is stored in destination directory of ROOT-to-numpy converter
+    and describes source ROOT files used to create each output file.
+    It allows to skip conversion of unchanged sources.
+
+    Manifest structure:
+        {
+            'version': converter version,
+            'entries': {
+                source directory name: {
+                    'source': {'path', 'size', 'mtime', 'hash'},
+                    'output': {'path', 'size', 'mtime'},
+                    'version': converter version
+                }
+            }
+        }
+    Output path is stored relatively to destination directory.
+"""
+
+import hashlib
+import os
+
+from nn4omtf.utils import dict_to_json, json_to_dict
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_hash(path, block_size=2**20):
+    """
+    Calculate SHA1 of file content.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def path_stat(path):
+    """
+    Get size and modification time of file or directory.
+    Directory size is a sum of sizes of all files inside,
+    modification time is the latest one.
+    Returns:
+        dict with `size` and `mtime` or None if path doesn't exist
+    """
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+    size = 0
+    mtime = os.stat(path).st_mtime
+    for root, _, files in os.walk(path):
+        for f in files:
+            st = os.stat(os.path.join(root, f))
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime)
+    return {'size': size, 'mtime': mtime}
+
+
+def source_signature(path, with_hash=False):
+    """
+    Describe source file.
+    Args:
+        path: source file path
+        with_hash: calculate hash of content
+    Returns:
+        dict with `path`, `size`, `mtime`, `hash` (None if not calculated)
+    """
+    sig = path_stat(path)
+    sig['path'] = os.path.abspath(path)
+    sig['hash'] = file_hash(path) if with_hash else None
+    return sig
+
+
+def load_manifest(dest, version):
+    """
+    Load manifest from destination directory or create empty one.
+    Args:
+        dest: converter destination directory
+        version: current converter version
+    """
+    path = os.path.join(dest, MANIFEST_NAME)
+    if os.path.exists(path):
+        manifest = json_to_dict(path)
+    else:
+        manifest = {'entries': {}}
+    manifest['version'] = version
+    return manifest
+
+
+def save_manifest(dest, manifest):
+    dict_to_json(os.path.join(dest, MANIFEST_NAME), manifest)
+
+
+def is_up_to_date(manifest, key, source, output, with_hash=False):
+    """
+    Check whether output was created from unchanged source
+    by current converter version.
+    If source modification time has changed but `with_hash` is set,
+    content hash is compared instead. If content is the same, new
+    modification time is written into manifest entry (manifest must be
+    saved after), so file isn't hashed again on next run.
+    Args:
+        manifest: manifest dict
+        key: entry key, source directory name
+        source: source file path
+        output: output path
+        with_hash: allow to compare content hashes
+    """
+    entry = manifest['entries'].get(key)
+    if entry is None or entry['version'] != manifest['version']:
+        return False
+    # Output format may have changed
+    if os.path.basename(entry['output']['path']) != os.path.basename(output):
+        return False
+    out = path_stat(output)
+    if out is None or out['size'] != entry['output']['size'] \
+            or out['mtime'] != entry['output']['mtime']:
+        return False
+    src = path_stat(source)
+    if src is None or src['size'] != entry['source']['size']:
+        return False
+    if src['mtime'] == entry['source']['mtime']:
+        return True
+    if with_hash and entry['source']['hash'] is not None:
+        if file_hash(source) != entry['source']['hash']:
+            return False
+        entry['source']['mtime'] = src['mtime']
+        return True
+    return False
+
+
+def update_manifest(manifest, key, source_sig, output, dest):
+    """
+    Add or replace manifest entry after successful conversion.
+    Args:
+        manifest: manifest dict
+        key: entry key, source directory name
+        source_sig: source signature taken before conversion,
+            see `source_signature`
+        output: output path
+        dest: converter destination directory
+    """
+    out = path_stat(output)
+    out['path'] = os.path.relpath(output, dest)
+    manifest['entries'][key] = {
+        'source': source_sig,
+        'output': out,
+        'version': manifest['version']
+    }
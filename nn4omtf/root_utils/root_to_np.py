@@ -13,18 +13,53 @@
     INFO - structure:
     This part of package is very specific. ROOT dict structure is defined by
     external program which generates data from OMTF simulation.
+    ROOT and root_numpy are imported only by functions reading ROOT files,
+    conversion of loaded data and benchmark work without them.
 """
 
-import ROOT
-from root_numpy import root2array
-
 import os
 import sys
 import re
+import shutil
 import time
 import numpy as np
 
-from nn4omtf.const import NPZ_FIELDS
+from nn4omtf.const_dataset import NPZ_FIELDS
+from nn4omtf.const_files import FILE_FORMATS
+from nn4omtf.utils import save_dict_as_npz, save_dict_as_npy_dir,\
+    save_npy_dir_meta, cast_checked
+from nn4omtf.root_utils.manifest import source_signature, path_stat
+
+
+# Increment when converted files content changes
+CONVERTER_VERSION = 2
+ROOT_FILE_NAME = 'OMTFHitsData.root'
+ROOT_TREE_NAME = 'omtfPatternMaker/OMTFHitsTree'
+# Per-event arrays in converted data
+NPZ_ARRAY_FIELDS = [
+    NPZ_FIELDS.HITS_FULL,
+    NPZ_FIELDS.HITS_REDUCED,
+    NPZ_FIELDS.PROD,
+    NPZ_FIELDS.OMTF]
+
+
+def parse_root_dir(path):
+    """
+    Extract dataset name, pt code and muon charge sign from directory name.
+    Directory name should match pattern "SignleMu_[0-9]+_[pm]".
+    Args:
+        path: path to directory containing ROOT file
+    Returns:
+        dict with dataset name, pt code, muon charge sign
+    """
+    basename = os.path.basename(os.path.normpath(path))
+    r = re.compile(r"(?P<name>[A-Za-z]+)_(?P<val>[0-9]+)_(?P<sign>[pm])")
+    m = r.match(basename)
+    if m is None:
+        raise ValueError("Provided path does not match pattern: name_[0-9]+_[pm]")
+    d = m.groupdict()
+    d['val'] = int(d['val'])
+    return d
 
 
 def load_root_dict(path):
@@ -41,16 +76,86 @@ def load_root_dict(path):
     Returns:
         (ROOT dict dataset, dict with dataset name, pt code, muon charge sign)
     """ 
-    NAME = 'OMTFHitsData.root'
-    fpath = os.path.join(path, NAME)
-    basename = os.path.basename(path)
-    r = re.compile(r"(?P<name>[A-Za-z]+)_(?P<val>[0-9]+)_(?P<sign>[pm])")
-    m = r.match(basename)
-    if m is None:
-        raise ValueError("Provided path does not match pattern: name_[0-9]+_[pm]")
-    d = m.groupdict()
-    d['val'] = int(d['val'])
-    return root2array(fpath, 'omtfPatternMaker/OMTFHitsTree'), d
+    from root_numpy import root2array
+    fpath = os.path.join(path, ROOT_FILE_NAME)
+    d = parse_root_dir(path)
+    return root2array(fpath, ROOT_TREE_NAME), d
+
+
+def iter_root_chunks(path, chunk_size):
+    """
+    Read ROOT's 'omtfPatternMaker/OMTFHitsTree' in chunks of events.
+    Only one chunk is kept in memory at once.
+    Args:
+        path: path to directory containing ROOT file, see `load_root_dict`
+        chunk_size: number of events in single chunk
+    Returns:
+        (total number of events, generator of (first event, ROOT dict chunk))
+    """
+    import ROOT
+    from root_numpy import tree2array
+    fpath = os.path.join(path, ROOT_FILE_NAME)
+    rfile = ROOT.TFile.Open(fpath)
+    if not rfile or rfile.IsZombie():
+        raise IOError("Cannot open ROOT file: " + fpath)
+    tree = rfile.Get(ROOT_TREE_NAME)
+    ev_n = int(tree.GetEntries())
+
+    def chunks():
+        try:
+            for start in range(0, ev_n, chunk_size):
+                yield start, tree2array(tree, start=start, 
+                        stop=start + chunk_size)
+        finally:
+            rfile.Close()
+    return ev_n, chunks()
+
+
+HITS_NULL = 5400
+
+
+def stack_hits(hits):
+    """
+    Stack HITS column of ROOT dataset into single array.
+    Depending on ROOT tree branch type, `root2array` returns HITS column
+    as sub-array field or as object array of per-event arrays.
+    Args:
+        hits: HITS column of dataset returned by `root2array`
+    Returns:
+        np.array of shape [events, 18, 14]
+    """
+    if hits.dtype != object:
+        return hits
+    return np.stack([np.stack(e) for e in hits])
+
+
+def reduce_hits(hits):
+    """
+    Reduce full HITS tensors [events, 18, 14] to [events, 18, 2].
+    In each layer, registered hits (values different than 5400) are taken:
+        - two hits are taken as they are,
+        - one hit is padded with 5400,
+        - if there is no hit or more than two, layer is set to 5400.
+    Whole batch of events is processed at once.
+    Args:
+        hits: full HITS tensors
+    Returns:
+        reduced HITS tensors
+    """
+    mask = hits != HITS_NULL
+    cnt = np.sum(mask, axis=-1)
+    # Find first and second registered hit in each layer
+    first = np.argmax(mask, axis=-1)[..., None]
+    np.put_along_axis(mask, first, False, axis=-1)
+    second = np.argmax(mask, axis=-1)[..., None]
+    first = np.take_along_axis(hits, first, axis=-1)[..., 0]
+    second = np.take_along_axis(hits, second, axis=-1)[..., 0]
+    res = np.full(hits.shape[:-1] + (2,), HITS_NULL, dtype=hits.dtype)
+    one = cnt == 1
+    two = cnt == 2
+    res[..., 0] = np.where(one | two, first, res[..., 0])
+    res[..., 1] = np.where(two, second, res[..., 1])
+    return res
 
 
 def root_to_numpy(name, sign, ptcode, data):
@@ -71,9 +176,10 @@ def root_to_numpy(name, sign, ptcode, data):
             (omtfCharge, omtfPt, omtfEta, omtfQuality, omtfHits, omtfRefLayer)
 
     Note: 
-        ROOT dicts are not imported as ndarray. 
-        They cannot be sliced and iterated using numpy tools.
-        Single dict conversion can last a few minutes.
+        All events are converted at once using whole-array numpy
+        operations. Output values are the same as from per-event 
+        conversion implemented in `_root_to_numpy_loop`, but HITS
+        are stored as `NPZ_FIELDS.HITS_DTYPE` (int16).
 
     Args: 
         name: extracted name from parent directory
@@ -83,6 +189,164 @@ def root_to_numpy(name, sign, ptcode, data):
     Returns:
         dict with data arrays, np.arrays of production data, OMTF data, hits 18x14, hits 18x2
     """
+    cols = data.dtype.names
+    hits14 = cast_checked(stack_hits(data[cols[0]]), NPZ_FIELDS.HITS_DTYPE)
+    prod = np.stack([data[c] for c in cols[1:5]], axis=1)
+    omtf = np.stack([data[c] for c in cols[5:11]], axis=1)
+    pt = data[cols[1]]
+
+    res = dict()
+    res[NPZ_FIELDS.HITS_FULL] = hits14
+    res[NPZ_FIELDS.HITS_REDUCED] = reduce_hits(hits14)
+    res[NPZ_FIELDS.PROD] = prod
+    res[NPZ_FIELDS.OMTF] = omtf
+    res[NPZ_FIELDS.PT_CODE] = ptcode
+    res[NPZ_FIELDS.PT_MAX] = pt.max()
+    res[NPZ_FIELDS.PT_MIN] = pt.min()
+    res[NPZ_FIELDS.NAME] = name
+    res[NPZ_FIELDS.SIGN] = sign
+    res[NPZ_FIELDS.EV_N] = data.shape[0]
+    return res
+
+
+
+def root_to_numpy_chunked(path, dest, chunk_size):
+    """
+    Streaming version of ROOT-to-numpy conversion.
+    Tree is read in chunks of `chunk_size` events. Each chunk is converted
+    with `root_to_numpy` and written into preallocated on-disk arrays,
+    so peak memory depends only on chunk size.
+    Args:
+        path: directory containing ROOT file, see `load_root_dict`
+        dest: directory for on-disk `*.npy` arrays
+        chunk_size: number of events in single chunk
+    Returns:
+        dict with same structure as `root_to_numpy` result,
+        array fields are memory-mapped `*.npy` files stored in `dest`
+    """
+    info = parse_root_dir(path)
+    name = info['name']
+    sign = info['sign']
+    pt_code = info['val']
+    ev_n, chunks = iter_root_chunks(path, chunk_size)
+    os.makedirs(dest, exist_ok=True)
+
+    res = dict()
+    pt_min = None
+    pt_max = None
+    for start, data in chunks:
+        x = root_to_numpy(name, sign, pt_code, data)
+        stop = start + x[NPZ_FIELDS.EV_N]
+        for k in NPZ_ARRAY_FIELDS:
+            if k not in res:
+                res[k] = np.lib.format.open_memmap(
+                        os.path.join(dest, k + '.npy'), mode='w+',
+                        dtype=x[k].dtype, shape=(ev_n,) + x[k].shape[1:])
+            res[k][start:stop] = x[k]
+        pt_min = x[NPZ_FIELDS.PT_MIN] if pt_min is None else \
+                min(pt_min, x[NPZ_FIELDS.PT_MIN])
+        pt_max = x[NPZ_FIELDS.PT_MAX] if pt_max is None else \
+                max(pt_max, x[NPZ_FIELDS.PT_MAX])
+    for arr in res.values():
+        arr.flush()
+
+    res[NPZ_FIELDS.PT_CODE] = pt_code
+    res[NPZ_FIELDS.PT_MAX] = pt_max
+    res[NPZ_FIELDS.PT_MIN] = pt_min
+    res[NPZ_FIELDS.NAME] = name
+    res[NPZ_FIELDS.SIGN] = sign
+    res[NPZ_FIELDS.EV_N] = ev_n
+    return res
+
+
+def get_output_path(path, dest, fmt=FILE_FORMATS.NPZ):
+    """
+    Get path of converted file.
+    Args:
+        path: directory containing ROOT file, see `load_root_dict`
+        dest: destination directory
+        fmt: output format, value from `FILE_FORMATS`
+    """
+    info = parse_root_dir(path)
+    name = "{}_{}_{}".format(info['name'], info['sign'], info['val'])
+    if fmt == FILE_FORMATS.NPZ:
+        name += '.npz'
+    return os.path.join(dest, name)
+
+
+def convert_root_dir(path, dest, chunk_size=None, with_hash=False, 
+        fmt=FILE_FORMATS.NPZ):
+    """
+    Convert ROOT dataset from single directory and save it in `dest`.
+    Output is saved as:
+        - `FILE_FORMATS.NPZ` - single compressed `*.npz` file,
+        - `FILE_FORMATS.NPY` - directory with uncompressed `*.npy` file
+          per array and `meta.json` with scalar fields, arrays can be
+          memory-mapped when loaded, see `load_npz_or_npy_dir`.
+    Args:
+        path: directory containing ROOT file, see `load_root_dict`
+        dest: destination directory
+        chunk_size: if not None, convert file in chunks of given 
+            number of events to limit memory usage
+        with_hash: calculate hash of source file content
+        fmt: output format, value from `FILE_FORMATS`
+    Returns:
+        dict with conversion summary: output path, number of events,
+        size of source and output files in bytes, conversion time,
+        source file signature taken before conversion
+    """
+    assert fmt in [FILE_FORMATS.NPZ, FILE_FORMATS.NPY], \
+            "Unknown output format: " + str(fmt)
+    time_start = time.time()
+    source = source_signature(os.path.join(path, ROOT_FILE_NAME), with_hash)
+    info = parse_root_dir(path)
+    name = info['name']
+    sign = info['sign']
+    pt_code = info['val']
+    out = get_output_path(path, dest, fmt)
+    # Output directory is assembled here and then moved into place
+    parts = out + '.parts'
+    if chunk_size is None:
+        data, _ = load_root_dict(path)
+        x = root_to_numpy(name, sign, pt_code, data)
+        if fmt == FILE_FORMATS.NPZ:
+            save_dict_as_npz(out, **x)
+        else:
+            save_dict_as_npy_dir(parts, **x)
+    else:
+        # Arrays are stored on disk and in case of `*.npz` 
+        # streamed into archive
+        x = root_to_numpy_chunked(path, parts, chunk_size)
+        if fmt == FILE_FORMATS.NPZ:
+            save_dict_as_npz(out, **x)
+        else:
+            save_npy_dir_meta(parts, {k: v for k, v in x.items() 
+                if k not in NPZ_ARRAY_FIELDS})
+        # Release memory maps before moving or removing their files
+        x = {NPZ_FIELDS.EV_N: x[NPZ_FIELDS.EV_N]}
+    if fmt == FILE_FORMATS.NPY:
+        if os.path.exists(out):
+            shutil.rmtree(out)
+        os.rename(parts, out)
+    elif os.path.exists(parts):
+        shutil.rmtree(parts)
+    return {
+        'path': out,
+        'ev_n': x[NPZ_FIELDS.EV_N],
+        'bytes_in': source['size'],
+        'bytes_out': path_stat(out)['size'],
+        'time': time.time() - time_start,
+        'source': source
+    }
+
+
+def _root_to_numpy_loop(name, sign, ptcode, data):
+    """
+    Reference per-event implementation of `root_to_numpy`.
+    Iterates over events and layers in Python, so single dict
+    conversion can last a few minutes.
+    Kept to validate and benchmark vectorized conversion.
+    """
     omtf = []
     prod = []
     hits14 = []
@@ -128,3 +392,43 @@ def root_to_numpy(name, sign, ptcode, data):
     return res
 
 
+# ===== BENCHMARK
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark vectorized ROOT-to-numpy conversion")
+    parser.add_argument('--events', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    FLAGS = parser.parse_args()
+
+    # Synthetic data shaped like `OMTFHitsTree` records
+    fields = ['muonPt', 'muonPhi', 'muonEta', 'muonCharge', 'omtfCharge',
+        'omtfPt', 'omtfEta', 'omtfQuality', 'omtfHits', 'omtfRefLayer']
+    dtype = [('hits', np.int32, (18, 14))] + [(f, np.float32) for f in fields]
+    rng = np.random.RandomState(FLAGS.seed)
+    data = np.zeros(FLAGS.events, dtype=dtype)
+    hits = rng.randint(-800, 800, size=(FLAGS.events, 18, 14))
+    hits[rng.rand(FLAGS.events, 18, 14) < 0.9] = HITS_NULL
+    data['hits'] = hits
+    for f in fields:
+        data[f] = rng.rand(FLAGS.events) * 100
+
+    print("Events: %d" % FLAGS.events)
+    t = time.time()
+    ref = _root_to_numpy_loop('SingleMu', 'p', 1, data)
+    t_loop = time.time() - t
+    print("Per-event conversion: %.3f sec." % t_loop)
+    t = time.time()
+    res = root_to_numpy('SingleMu', 'p', 1, data)
+    t_vec = time.time() - t
+    print("Vectorized conversion: %.3f sec." % t_vec)
+    print("Speedup: %.1fx" % (t_loop / t_vec))
+
+    for k, v in ref.items():
+        r = np.asarray(res[k])
+        # HITS are stored in compact type
+        v = np.asarray(v).astype(r.dtype)
+        assert v.shape == r.shape, k + ' mismatch!'
+        assert v.tobytes() == r.tobytes(), k + ' mismatch!'
+    print("Outputs are identical.")
@@ -12,6 +12,7 @@ import time
 from nn4omtf import OMTFInputPipe
 from nn4omtf.utils import dict_to_object, to_sec
 from nn4omtf.const_dataset import DATASET_TYPES
+from nn4omtf.const_files import COMPRESSION
 
 class OMTFRunner:
 
@@ -50,7 +51,8 @@ class OMTFRunner:
 
 
     def train(self, model, no_checkpoints=False, time_limit=None, epochs=1, 
-            train_summary_ival=None, validation_ival=None, **opts):
+            train_summary_ival=None, validation_ival=None, stream=False, 
+            **opts):
         """
         Run model training.
         Args:
@@ -61,6 +63,8 @@ class OMTFRunner:
             train_summary_ival: get train summary batches interval
             validation_ival: batches interval between validations, if `None` 
                 validation is run only at the end of epoch
+            stream: stream datasets from disk instead of loading them 
+                into memory, see `OMTFInputPipe`
         """
         get_def = lambda x, y: y if x is None else x
         self.train_summary_ival = get_def(train_summary_ival, 5000)
@@ -74,10 +78,10 @@ class OMTFRunner:
         with tf.name_scope("input_pipes"):
             self.pipe_train = OMTFInputPipe(self.model_config.ds_train, 
                     DATASET_TYPES.TRAIN, self.pt_bins, 
-                    batch_size=self.model_hparams.batch_size)
+                    batch_size=self.model_hparams.batch_size, stream=stream)
             self.pipe_valid = OMTFInputPipe(self.model_config.ds_valid, 
                     DATASET_TYPES.VALID, self.pt_bins, 
-                    batch_size=self.model_hparams.batch_size)
+                    batch_size=self.model_hparams.batch_size, stream=stream)
             t_init, t_next = self.pipe_train.get_initializer_and_op()
 
         with tf.Session() as sess:
@@ -155,13 +159,16 @@ class OMTFRunner:
         self.pipe_valid.close()
 
 
-    def test(self, model, note='', suffix=None, **opts):
+    def test(self, model, note='', suffix=None, 
+            compression=COMPRESSION.FAST, stream=False, **opts):
         """
         Run model test.
         Pass whole TEST dataset through network and save raw logits.
         Args:
             model: OMTFModel instance
             note: note to store along with results array
+            compression: results files compression, from `COMPRESSION`
+            stream: stream TEST dataset from disk, see `OMTFInputPipe`
         """
         test_batch_size = 512
         self.model = model
@@ -172,7 +179,7 @@ class OMTFRunner:
         with tf.name_scope("input_pipes"):
             self.pipe_test = OMTFInputPipe(self.model_config.ds_test, 
                     DATASET_TYPES.TEST, self.pt_bins, 
-                    batch_size=test_batch_size)
+                    batch_size=test_batch_size, stream=stream)
             t_init, t_next = self.pipe_test.get_initializer_and_op()
 
         results = None
@@ -220,7 +227,7 @@ class OMTFRunner:
             print("Mean sec. per batch: %f" % (self.time_elapsed / batch_n))
             self.print_log("TEST", 1, batch_n, loss, acc)
             self.model.save_test_results(results, suffix=suffix,
-                    note=note)
+                    note=note, compression=compression)
         self.pipe_test.close()
 
 
@@ -8,11 +8,12 @@
 
 import numpy as np
 
-from .utils import dict_to_json
+from .utils import dict_to_json, save_npz
 from .const_dataset import DATASET_TYPES, DATASET_FIELDS
 from .const_model import MODEL_RESULTS  
 from .const_stats import TEST_STATISTICS_FIELDS
-from .const_files import FILE_TYPES
+from .const_files import FILE_TYPES, COMPRESSION
+from .dataset_files import iter_dataset_shards, iter_dataset_blocks
 
 from .const_pt import PT_CODES_BINS, OMTF_BINS, PT_CODES_RANGES
 
@@ -20,21 +21,26 @@ from .const_pt import PT_CODES_BINS, OMTF_BINS, PT_CODES_RANGES
 class OMTFStatistics:
     """
     Generate statistic from TEST run results.
-    NOTE: TEST dataset actually cannot be too big.
+    TEST dataset is read block by block (blocks don't cross shards)
+    and histograms are accumulated, so it doesn't have to fit in memory.
+    Only NN results are loaded whole.
 
     """
 
-    def __init__(self, path_ds_test, path_results):
+    # Events masks, histograms are generated for each of them
+    MASKS = ['all', 'q12', 'ptnn', 'ptnnq12']
+
+
+    def __init__(self, path_ds_test, path_results, block_size=2**20):
         """
         Prepare a lot of data to create many histograms which 
         are base for all others statistics.
+        Args:
+            path_ds_test: TEST dataset file or directory
+            path_results: TEST run results `*.npz` file
+            block_size: number of examples read at once
         """
-        self.file_dataset = np.load(path_ds_test)
         self.file_results = np.load(path_results)
-        dataset = self.file_dataset[DATASET_TYPES.TEST].item()
-
-        isnull = dataset[DATASET_FIELDS.IS_NULL]
-        N = isnull.shape[0]
         
         # ========= SIGN
         sign_n = 3
@@ -42,10 +48,6 @@ class OMTFStatistics:
 
         # ========= NN DATA
         nn_logits_arr = self.file_results[MODEL_RESULTS.RESULTS]
-        nn_cls_arr = np.argmax(nn_logits_arr, axis=1)
-        nn_pt_arr = (nn_cls_arr + 1) // 2
-        nn_sign_arr = np.where(nn_cls_arr == 0, 0, (nn_cls_arr + 1) % 2 + 1)
-
         nn_bins = self.file_results[MODEL_RESULTS.PT_BINS]
 
         nn_cls_n = 2 * len(nn_bins) + 1
@@ -56,14 +58,6 @@ class OMTFStatistics:
 
         # ========= OMTF DATA
         omtf_bins = OMTF_BINS
-        omtf_ptval_arr = dataset[DATASET_FIELDS.OMTF_PT]
-        omtf_sign_arr = dataset[DATASET_FIELDS.OMTF_SIGN]
-        omtf_q_arr = dataset[DATASET_FIELDS.OMTF_QUALITY]
-        omtf_cls_arr = OMTFStatistics.get_cls(omtf_ptval_arr, omtf_sign_arr, omtf_bins)
-        omtf_nn_cls_arr = OMTFStatistics.get_cls(omtf_ptval_arr, omtf_sign_arr, nn_bins)
-        omtf_pt_arr = (omtf_cls_arr + 1) // 2
-        omtf_sign_arr = np.where(omtf_cls_arr == 0, 0, (omtf_cls_arr + 1) % 2 + 1)
-
         omtf_cls_n = 2 * len(omtf_bins) + 1
         omtf_pt_n = len(omtf_bins) + 1
         omtf_pt_labels = ['N'] + list(range(1, omtf_pt_n))
@@ -71,58 +65,38 @@ class OMTFStatistics:
         omtf_pt_ranges = [(None, 0)] + list(zip(OMTF_BINS[:-1], OMTF_BINS[1:])) + [(OMTF_BINS[-1], None)]
         
         # ========= MUON DATA
-        muon_pt_arr = dataset[DATASET_FIELDS.PT_VAL]
-        muon_sign_arr = dataset[DATASET_FIELDS.SIGN]
-        muon_sign_cls_arr = np.where(dataset[DATASET_FIELDS.SIGN] > 0, 1, 2)
-        muon_sign_cls_wn_arr = np.where(isnull, 0, muon_sign_cls_arr)
-        muon_nn_cls_arr = OMTFStatistics.get_cls(muon_pt_arr, muon_sign_arr, nn_bins)
-        muon_omtf_cls_arr = OMTFStatistics.get_cls(muon_pt_arr, muon_sign_arr, omtf_bins)
-        muon_nn_cls_wn_arr = OMTFStatistics.get_cls(muon_pt_arr, muon_sign_arr, nn_bins, isnull)
-        muon_omtf_cls_wn_arr = OMTFStatistics.get_cls(muon_pt_arr, muon_sign_arr, omtf_bins, isnull)
-
-
-        muon_ptc_arr = dataset[DATASET_FIELDS.PT_CODE] - 1
-        muon_ptc_list = np.unique(muon_ptc_arr)
+        # pT codes of whole dataset are needed before histograms are made
+        muon_ptc_list = np.unique(np.concatenate([np.unique(s[DATASET_FIELDS.PT_CODE])
+            for s in iter_dataset_shards(path_ds_test, DATASET_TYPES.TEST,
+                fields=[DATASET_FIELDS.PT_CODE])])) - 1
         muon_ptc_n = len(muon_ptc_list)
         muon_ptc_ranges = PT_CODES_RANGES
         muon_ptc_labels = list(map(int, muon_ptc_list + 1))
 
-        # ===== SOURCE DATA FOR HISTOGRAMS  
-
-        # key, data array normalized, classes range, ranges, classes labels 
-        data = [
+        # ===== HISTOGRAMS AXES
+        # key, classes range, ranges, classes labels 
+        axes = [
             # pT codes
-            ('muon_ptc', muon_ptc_arr, muon_ptc_n, muon_ptc_ranges, muon_ptc_labels),
+            ('muon_ptc', muon_ptc_n, muon_ptc_ranges, muon_ptc_labels),
             # Ground Truths for NN and OMTF
-            ('muon_nn_cls', muon_nn_cls_arr, nn_cls_n, None, nn_cls_labels),
-            ('muon_nn_cls_wn', muon_nn_cls_wn_arr, nn_cls_n, None, nn_cls_labels),
-            ('muon_omtf_cls', muon_omtf_cls_arr, omtf_cls_n, None, omtf_cls_labels),
+            ('muon_nn_cls', nn_cls_n, None, nn_cls_labels),
+            ('muon_nn_cls_wn', nn_cls_n, None, nn_cls_labels),
+            ('muon_omtf_cls', omtf_cls_n, None, omtf_cls_labels),
             # NN and OMTF full outputs 
-            ('nn_cls', nn_cls_arr, nn_cls_n, None, nn_cls_labels),
-            ('omtf_cls', omtf_cls_arr, omtf_cls_n, None, omtf_cls_labels),
+            ('nn_cls', nn_cls_n, None, nn_cls_labels),
+            ('omtf_cls', omtf_cls_n, None, omtf_cls_labels),
             # OMTF outputs applied to NN bins
-            ('omtf_nn_cls', omtf_nn_cls_arr, nn_cls_n, None, nn_cls_labels),
+            ('omtf_nn_cls', nn_cls_n, None, nn_cls_labels),
             # NN and OMTF pt only outputs (signs merged)
-            ('nn_pt', nn_pt_arr, nn_pt_n, nn_pt_ranges, nn_pt_labels),
-            ('omtf_pt', omtf_pt_arr, omtf_pt_n, omtf_pt_ranges, omtf_pt_labels),
+            ('nn_pt', nn_pt_n, nn_pt_ranges, nn_pt_labels),
+            ('omtf_pt', omtf_pt_n, omtf_pt_ranges, omtf_pt_labels),
             # MUON, NN, OMTF sign only data
-            ('muon_sign', muon_sign_cls_arr, sign_n, None, sign_labels),
-            ('muon_sign_wn', muon_sign_cls_wn_arr, sign_n, None, sign_labels),
-            ('nn_sign', nn_sign_arr, sign_n, None, sign_labels),
-            ('omtf_sign', omtf_sign_arr, sign_n, None, sign_labels),
+            ('muon_sign', sign_n, None, sign_labels),
+            ('muon_sign_wn', sign_n, None, sign_labels),
+            ('nn_sign', sign_n, None, sign_labels),
+            ('omtf_sign', sign_n, None, sign_labels),
         ]
-        self.data = dict([(x[0], x[1:]) for x in data])
-
-        # Events masks
-        self.masks = {
-            'all': np.ones(N).astype(np.bool),
-            # OMTF algorithm had good enough data quality
-            'q12': omtf_q_arr == 12.,
-            # OMTF tried to guess pt value
-            'ptnn': omtf_pt_arr > 0,
-            # Both, non-null answer and good quality
-            'ptnnq12': np.logical_and(omtf_q_arr == 12., omtf_pt_arr > 0)
-        }
+        self.axes = dict([(x[0], x[1:]) for x in axes])
 
         # ===== HISTOGRAMS TO GENERATE
         # == (hist key, xs data key, ys data key, mask key)
@@ -137,30 +111,111 @@ class OMTFStatistics:
         hists_to_generate = []
         # Generate histograms for all masks
         for k, sx, sy in _htg:
-            for mk, _ in self.masks.items():
+            for mk in OMTFStatistics.MASKS:
                 hists_to_generate += [(k + '_' + mk, sx, sy, mk)]
 
         # ===== CURVES TO GENERATE
         # Put index of entry from list above
         _ctg = ['ptc_nnpt', 'ptc_omtfpt']
-        curves_to_generate = [x+'_'+y for y in self.masks.keys() for x in _ctg]
+        curves_to_generate = [x+'_'+y for y in OMTFStatistics.MASKS for x in _ctg]
 
         # ===== ACCURACY TO CALCULATE
         # Put index of entry from list above
         _atc = ['nn_self', 'omtf_self', 'omtf_as_nn']
-        accuracy_to_calculate = [x+'_'+y for y in self.masks.keys() for x in _atc]
+        accuracy_to_calculate = [x+'_'+y for y in OMTFStatistics.MASKS for x in _atc]
+
+        self.histograms = dict()
+        fields = [DATASET_FIELDS.IS_NULL, DATASET_FIELDS.PT_VAL, 
+            DATASET_FIELDS.SIGN, DATASET_FIELDS.PT_CODE, 
+            DATASET_FIELDS.OMTF_PT, DATASET_FIELDS.OMTF_SIGN, 
+            DATASET_FIELDS.OMTF_QUALITY]
+        offset = 0
+        for block in iter_dataset_blocks(path_ds_test, DATASET_TYPES.TEST,
+                block_size, fields=fields):
+            n = block[DATASET_FIELDS.IS_NULL].shape[0]
+            logits = nn_logits_arr[offset:offset + n]
+            assert logits.shape[0] == n, "Less results than TEST examples!"
+            data, masks = OMTFStatistics.get_block_data(block, logits, nn_bins)
+            self.generate_histograms(hists_to_generate, data, masks)
+            offset += n
+        assert offset == nn_logits_arr.shape[0], "More results than TEST examples!"
 
-        self.generate_histograms(hists_to_generate)
         self.generate_curves(curves_to_generate)
         self.calculate_accuracy(accuracy_to_calculate)
 
 
+    def get_block_data(block, nn_logits_arr, nn_bins):
+        """
+        Calculate histograms source data of single block of examples.
+        Args:
+            block: dict of TEST dataset fields
+            nn_logits_arr: NN results of examples in block
+            nn_bins: NN pt bins
+        Returns:
+            (dict( data key: array ), dict( mask key: array ))
+        """
+        isnull = block[DATASET_FIELDS.IS_NULL]
+        N = isnull.shape[0]
+
+        # ========= NN DATA
+        nn_cls_arr = np.argmax(nn_logits_arr, axis=1)
+        nn_pt_arr = (nn_cls_arr + 1) // 2
+        nn_sign_arr = np.where(nn_cls_arr == 0, 0, (nn_cls_arr + 1) % 2 + 1)
+
+        # ========= OMTF DATA
+        omtf_bins = OMTF_BINS
+        omtf_ptval_arr = block[DATASET_FIELDS.OMTF_PT]
+        omtf_sign_arr = block[DATASET_FIELDS.OMTF_SIGN]
+        omtf_q_arr = block[DATASET_FIELDS.OMTF_QUALITY]
+        omtf_cls_arr = OMTFStatistics.get_cls(omtf_ptval_arr, omtf_sign_arr, omtf_bins)
+        omtf_nn_cls_arr = OMTFStatistics.get_cls(omtf_ptval_arr, omtf_sign_arr, nn_bins)
+        omtf_pt_arr = (omtf_cls_arr + 1) // 2
+        omtf_sign_arr = np.where(omtf_cls_arr == 0, 0, (omtf_cls_arr + 1) % 2 + 1)
+
+        # ========= MUON DATA
+        muon_pt_arr = block[DATASET_FIELDS.PT_VAL]
+        muon_sign_arr = block[DATASET_FIELDS.SIGN]
+        muon_sign_cls_arr = np.where(block[DATASET_FIELDS.SIGN] > 0, 1, 2)
+        muon_sign_cls_wn_arr = np.where(isnull, 0, muon_sign_cls_arr)
+        muon_nn_cls_arr = OMTFStatistics.get_cls(muon_pt_arr, muon_sign_arr, nn_bins)
+        muon_omtf_cls_arr = OMTFStatistics.get_cls(muon_pt_arr, muon_sign_arr, omtf_bins)
+        muon_nn_cls_wn_arr = OMTFStatistics.get_cls(muon_pt_arr, muon_sign_arr, nn_bins, isnull)
+        muon_omtf_cls_wn_arr = OMTFStatistics.get_cls(muon_pt_arr, muon_sign_arr, omtf_bins, isnull)
+        muon_ptc_arr = block[DATASET_FIELDS.PT_CODE] - 1
+
+        data = {
+            'muon_ptc': muon_ptc_arr,
+            'muon_nn_cls': muon_nn_cls_arr,
+            'muon_nn_cls_wn': muon_nn_cls_wn_arr,
+            'muon_omtf_cls': muon_omtf_cls_arr,
+            'nn_cls': nn_cls_arr,
+            'omtf_cls': omtf_cls_arr,
+            'omtf_nn_cls': omtf_nn_cls_arr,
+            'nn_pt': nn_pt_arr,
+            'omtf_pt': omtf_pt_arr,
+            'muon_sign': muon_sign_cls_arr,
+            'muon_sign_wn': muon_sign_cls_wn_arr,
+            'nn_sign': nn_sign_arr,
+            'omtf_sign': omtf_sign_arr,
+        }
+
+        masks = {
+            'all': np.ones(N, dtype=bool),
+            # OMTF algorithm had good enough data quality
+            'q12': omtf_q_arr == 12.,
+            # OMTF tried to guess pt value
+            'ptnn': omtf_pt_arr > 0,
+            # Both, non-null answer and good quality
+            'ptnnq12': np.logical_and(omtf_q_arr == 12., omtf_pt_arr > 0)
+        }
+        return data, masks
+
+
     def __enter__(self):
         return self
 
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.file_dataset.close()
         self.file_results.close()
 
 
@@ -196,13 +251,16 @@ class OMTFStatistics:
         return s.T
 
 
-    def generate_histograms(self, hs_list):
-        self.histograms = dict()
+    def generate_histograms(self, hs_list, data, masks):
+        """
+        Add histograms of single block of examples to `self.histograms`.
+        """
         for k, kx, ky, km in hs_list:
-            xs, xn, xr, xl = self.data[kx]
-            ys, yn, yr, yl = self.data[ky]
-            m = self.masks[km]
-            hs = OMTFStatistics.mkhist2d(xs, ys, xn, yn, m)
+            xn, xr, xl = self.axes[kx]
+            yn, yr, yl = self.axes[ky]
+            hs = OMTFStatistics.mkhist2d(data[kx], data[ky], xn, yn, masks[km])
+            if k in self.histograms:
+                hs += self.histograms[k][0]
             self.histograms[k] = hs, (xn, xr, xl), (yn, yr, yl) 
 
     
@@ -221,9 +279,13 @@ class OMTFStatistics:
             self.accuracies[kh] = hs.trace() / hs.sum()
 
 
-    def save(self, path, summary=True):
+    def save(self, path, summary=True, compression=COMPRESSION.FAST):
         """
         Save statistics data as `.npz` file.
+        Args:
+            path: output file path
+            summary: save also accuracies in `*_summary.json` file
+            compression: value from `COMPRESSION`
         """
         l = [
             TEST_STATISTICS_FIELDS.HISTOGRAMS,
@@ -236,7 +298,7 @@ class OMTFStatistics:
             self.accuracies
         ]
         data = {FILE_TYPES.TEST_STATISTICS: dict(zip(l,f))}
-        np.savez_compressed(path, **data) 
+        save_npz(path, compression=compression, **data)
         if summary:
             dict_to_json(path + '_summary.json', 
                 {TEST_STATISTICS_FIELDS.ACCURACIES: self.accuracies})
@@ -1,6 +1,11 @@
-from nn4omtf.utils.np_utils import save_dict_as_npz, load_dict_from_npz
+from nn4omtf.utils.np_utils import save_dict_as_npz, load_dict_from_npz,\
+    save_dict_as_npy_dir, save_npy_dir_meta, load_npz_or_npy_dir, NpyDirFile, cast_checked,\
+    rows_multiset_hash, int_value_counts, bins_index, histogram_of_counts,\
+    load_npz_member, save_npz, load_npz_header, load_npz_member_head
 from nn4omtf.utils.py_utils import import_module_from_path,\
-    get_from_module_by_name, get_source_of_obj, dict_to_object, obj_elems
+    get_from_module_by_name, get_source_of_obj, dict_to_object, obj_elems,\
+    prefetch_iter
+from nn4omtf.utils.prof_utils import StageProfiler, io_counters, peak_rss
 from nn4omtf.utils.utils import to_sec, dict_to_json, dict_to_json_string, \
     json_to_dict
 
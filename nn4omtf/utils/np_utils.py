@@ -5,9 +5,36 @@
     Loading and saving data in *.npz format.
     It looks like this module is not very useful but
     after np.load() returned object is not pure dict with np.arrays.
+
+    Data can be also stored as directory of uncompressed `*.npy` files,
+    one per array, with scalars kept in `meta.json`.
+    Such arrays can be memory-mapped on load.
+
+    `*.npz` files saved by `save_npz` have JSON header in archive comment
+    with names, dtypes and shapes of arrays (and any other metadata),
+    it can be read without loading or decompressing arrays.
 """
 
+import json
 import numpy as np
+import os
+import struct
+import sys
+import zipfile
+
+from .utils import dict_to_json, json_to_dict
+from nn4omtf.const_files import COMPRESSION
+
+
+NPY_DIR_META = 'meta.json'
+# Deflate levels, None - no compression
+COMPRESSION_LEVELS = {
+    COMPRESSION.NONE: None,
+    COMPRESSION.FAST: 1,
+    COMPRESSION.MAX: 9
+}
+# Zip archive comment length limit
+NPZ_HEADER_MAX = 2**16 - 1
 
 
 def save_dict_as_npz(path, **kw):
@@ -21,6 +48,69 @@ def save_dict_as_npz(path, **kw):
     np.savez_compressed(file=path, **kw)
 
 
+def save_npz(path, compression=COMPRESSION.NONE, header=None, **kw):
+    """Save arrays into `*.npz` file with selected compression.
+    Works like `np.savez` and `np.savez_compressed` (default level 6), 
+    but deflate level can be set. Python older than 3.7 can't set 
+    deflate level nor write zip members as streams, there `np.savez`
+    or `np.savez_compressed` is used and header is appended after.
+    Args:
+        path: path to file, `.npz` is appended if missing
+        compression: value from `COMPRESSION`
+        header: dict of JSON-serializable metadata stored in header,
+            see `load_npz_header`
+        **kw: arrays to save
+    """
+    level = COMPRESSION_LEVELS[compression]
+    if not path.endswith('.npz'):
+        path = path + '.npz'
+    kw = dict([(k, np.asanyarray(v)) for k, v in kw.items()])
+    arrays = dict([(k, {'dtype': v.dtype.str, 'shape': list(v.shape)}) 
+        for k, v in kw.items()])
+    header = dict(header or dict(), arrays=arrays)
+    s = json.dumps(header, sort_keys=True).encode('utf-8')
+    if len(s) > NPZ_HEADER_MAX:
+        print('Header too long, not saved in: %s' % path)
+        s = None
+
+    if sys.version_info < (3, 7):
+        if level is None:
+            np.savez(path, **kw)
+        else:
+            np.savez_compressed(path, **kw)
+        if s is not None:
+            with zipfile.ZipFile(path, mode='a') as zf:
+                zf.comment = s
+        return
+
+    method = zipfile.ZIP_STORED if level is None else zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(path, mode='w', compression=method, 
+            compresslevel=level, allowZip64=True) as zf:
+        for k, v in kw.items():
+            with zf.open(k + '.npy', mode='w', force_zip64=True) as f:
+                np.lib.format.write_array(f, v, allow_pickle=True)
+        if s is not None:
+            zf.comment = s
+
+
+def load_npz_header(path):
+    """Load header of `*.npz` file saved by `save_npz`.
+    Only zip directory is read, arrays are not touched.
+    Args:
+        path: path to `*.npz` file
+    Returns:
+        header dict, None if file has no header
+    """
+    with zipfile.ZipFile(path) as zf:
+        comment = zf.comment
+    if not comment:
+        return None
+    try:
+        return json.loads(comment.decode('utf-8'))
+    except ValueError:
+        return None
+
+
 def load_dict_from_npz(path):
     """Loads dictionary saved in *.npz file.
     Args:
@@ -32,3 +122,314 @@ def load_dict_from_npz(path):
     data = dict(data)
     return { k: v if v.size != 1 else v.item() for k, v in data.items() }
     
+
+
+def cast_checked(arr, dtype):
+    """Cast array to given dtype.
+    For integer dtypes, check first whether all values fit in its range.
+    Args:
+        arr: array to cast
+        dtype: target dtype
+    Returns:
+        array of dtype `dtype`, `arr` itself if it already has that dtype
+    """
+    dtype = np.dtype(dtype)
+    arr = np.asarray(arr)
+    if arr.dtype == dtype:
+        return arr
+    if dtype.kind in 'iu' and arr.size > 0:
+        info = np.iinfo(dtype)
+        if arr.min() < info.min or arr.max() > info.max:
+            raise ValueError("Array values out of %s range!" % dtype.name)
+    return arr.astype(dtype)
+
+
+# Initial state of row hash, see `rows_multiset_hash`
+_HASH_SEED = 0x9e3779b97f4a7c15
+
+
+def _mix64(z):
+    """SplitMix64 finalizer applied on uint64 array."""
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
+
+
+def rows_multiset_hash(arrays, block_size=2**20):
+    """Calculate order independent hash of rows.
+    Row `i` consists of `arr[i]` of all given arrays. Each row is hashed
+    and hashes are summed modulo 2^64, so result doesn't change when
+    rows are permuted. Row hash is seeded with row length, so zero rows
+    don't hash to zero and each of them is counted. Arrays are read 
+    in blocks, memory-mapped arrays are not loaded at once.
+    Args:
+        arrays: list of arrays with same first dimension
+        block_size: number of rows hashed at once
+    Returns:
+        hash value as int
+    """
+    n = arrays[0].shape[0]
+    total = 0
+    for b in range(0, n, block_size):
+        e = min(b + block_size, n)
+        parts = [np.ascontiguousarray(arr[b:e]).reshape(e - b, -1).view(np.uint8)
+                for arr in arrays]
+        rows = np.concatenate(parts, axis=1)
+        length = rows.shape[1]
+        pad = -length % 8
+        if pad > 0:
+            rows = np.pad(rows, ((0, 0), (0, pad)), mode='constant')
+        words = rows.view(np.uint64)
+        h = _mix64(np.full(e - b, _HASH_SEED ^ length, dtype=np.uint64))
+        for j in range(words.shape[1]):
+            h = _mix64(h ^ words[:, j])
+        total = (total + int(np.sum(h, dtype=np.uint64))) % 2**64
+    return total
+
+
+def int_value_counts(arr):
+    """Count occurrences of each value in integer array.
+    Wide integers from small range are counted with `np.bincount`.
+    Narrow integers (e.g. int16 HITS) are sorted instead, it's faster 
+    than widening whole array to index type required by `np.bincount`.
+    Args:
+        arr: integer array of any shape
+    Returns:
+        (values, counts) - distinct values and its counts
+    """
+    arr = np.asarray(arr).ravel()
+    if arr.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    lo = int(arr.min())
+    hi = int(arr.max())
+    if arr.dtype.itemsize >= np.dtype(np.intp).itemsize and \
+            hi - lo <= 4 * arr.size:
+        counts = np.bincount((arr - lo).astype(np.intp, copy=False))
+        values = np.flatnonzero(counts)
+        return values + lo, counts[values]
+    srt = np.sort(arr)
+    begins = np.concatenate([[0], np.flatnonzero(srt[1:] != srt[:-1]) + 1])
+    counts = np.diff(np.concatenate([begins, [srt.shape[0]]]))
+    return srt[begins].astype(np.int64), counts
+
+
+def bins_index(x, bins):
+    """Get index of histogram bin for each value.
+    Bins follow `np.histogram` rules: `bins[i] <= x < bins[i + 1]`, 
+    last bin includes right edge. For uniform bins (`np.linspace`)
+    index is calculated directly and only corrected by comparison 
+    with neighbouring edges.
+    Args:
+        x: array of values
+        bins: increasing array of bins edges
+    Returns:
+        array of bins indices, -1 for values out of bins range
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = bins.shape[0] - 1
+    lo, hi = bins[0], bins[-1]
+    if np.allclose(np.diff(bins), (hi - lo) / n):
+        idx = np.floor((x - lo) * (n / (hi - lo))).astype(np.intp)
+        idx = np.clip(idx, 0, n - 1)
+        idx -= x < bins[idx]
+        idx = np.clip(idx, 0, n - 1)
+        idx += (x >= bins[idx + 1]) & (idx < n - 1)
+    else:
+        idx = np.clip(np.searchsorted(bins, x, side='right') - 1, 0, n - 1)
+    return np.where((x < lo) | (x > hi), -1, idx)
+
+
+def histogram_of_counts(values, counts, bins):
+    """Calculate histogram of values given with its counts.
+    Same result as `np.histogram(data, bins=bins)[0]` when `values, counts`
+    are taken from `int_value_counts(data)`, but binning is done only
+    for distinct values.
+    Args:
+        values: distinct values
+        counts: number of occurrences of each value
+        bins: bins edges
+    Returns:
+        histogram as int64 array
+    """
+    idx = bins_index(values, bins)
+    ok = idx >= 0
+    hist = np.bincount(idx[ok], weights=counts[ok], 
+            minlength=bins.shape[0] - 1)
+    return hist.astype(np.int64)
+
+
+def save_dict_as_npy_dir(path, **kw):
+    """Save dict passed as kwargs into directory of `*.npy` files.
+    Arrays are saved as separate uncompressed `*.npy` files, 
+    all other values (scalars, strings) are saved in `meta.json`.
+    Args:
+        path: path to directory
+        kw: key words with data to save
+    """
+    os.makedirs(path, exist_ok=True)
+    meta = dict()
+    for k, v in kw.items():
+        if isinstance(v, np.ndarray) and v.ndim > 0:
+            np.save(os.path.join(path, k + '.npy'), v)
+        else:
+            meta[k] = v
+    save_npy_dir_meta(path, meta)
+
+
+def save_npy_dir_meta(path, meta):
+    """Save `meta.json` of `*.npy` directory.
+    Args:
+        path: path to directory
+        meta: dict with scalar values
+    """
+    meta = {k: v.item() if isinstance(v, np.generic) else v 
+            for k, v in meta.items()}
+    dict_to_json(os.path.join(path, NPY_DIR_META), meta)
+
+
+class NpyDirFile:
+    """
+    Lazy, read-only view of directory created by `save_dict_as_npy_dir`.
+    Mimics interface of object returned by `np.load` for `*.npz` files.
+    Arrays are loaded on access, memory-mapped if `mmap_mode` is set.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self.meta = json_to_dict(os.path.join(path, NPY_DIR_META))
+        self.arrays = sorted(f[:-4] for f in os.listdir(path) 
+                if f.endswith('.npy'))
+        self.files = self.arrays + list(self.meta.keys())
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __contains__(self, key):
+        return key in self.files
+
+
+    def __getitem__(self, key):
+        if key in self.meta:
+            return self.meta[key]
+        if key not in self.arrays:
+            raise KeyError("%s is not a file in %s" % (key, self.path))
+        return np.load(os.path.join(self.path, key + '.npy'), 
+                mmap_mode=self.mmap_mode)
+
+
+    def close(self):
+        pass
+
+
+def load_npz_member(path, key, mmap_mode=None):
+    """Load single array from `*.npz` file.
+    Arrays stored without compression (`np.savez`) can be 
+    memory-mapped directly from the archive.
+    Args:
+        path: path to `*.npz` file
+        key: array name
+        mmap_mode: memory-map mode, array is read into memory if None
+            or if it's compressed
+    Returns:
+        array or memory-mapped array
+    """
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(key + '.npy')
+        if mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+            with zf.open(info) as f:
+                return np.lib.format.read_array(f)
+    with open(path, 'rb') as f:
+        # Skip zip local file header
+        f.seek(info.header_offset)
+        local = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', local[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        offset = f.tell()
+    return np.memmap(path, dtype=dtype, mode=mmap_mode, offset=offset, 
+            shape=shape, order='F' if fortran_order else 'C')
+
+
+def load_npz_member_head(path, key, n):
+    """Load first `n` rows of array from `*.npz` file.
+    Compressed array is decompressed only up to `n`-th row.
+    Scalars (0-d arrays) and object arrays are returned whole.
+    Args:
+        path: path to `*.npz` file
+        key: array name
+        n: number of rows
+    Returns:
+        array
+    """
+    with zipfile.ZipFile(path) as zf:
+        with zf.open(key + '.npy') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            if dtype.hasobject or len(shape) == 0:
+                # Scalars and pickled objects have no rows
+                f.seek(0)
+                return np.lib.format.read_array(f, allow_pickle=True)
+            if fortran_order:
+                # Rows are not stored one by one
+                f.seek(0)
+                return np.lib.format.read_array(f)[:n]
+            n = min(n, shape[0])
+            row_size = dtype.itemsize * int(np.prod(shape[1:]))
+            buf = f.read(n * row_size)
+    return np.frombuffer(buf, dtype=dtype).reshape((n,) + tuple(shape[1:]))
+
+
+def load_npz_or_npy_dir(path, mmap_mode='r'):
+    """Open `*.npz` file or directory of `*.npy` files.
+    In both cases arrays are read only when accessed.
+    Args:
+        path: path to `*.npz` file or `*.npy` directory
+        mmap_mode: memory-map mode for `*.npy` arrays
+    Returns:
+        NpzFile or NpyDirFile
+    """
+    if os.path.isdir(path):
+        return NpyDirFile(path, mmap_mode=mmap_mode)
+    return np.load(path)
+
+
+# ===== TEST
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(0)
+    hits = rng.randint(-800, 800, size=(1000, 18, 2)).astype(np.int16)
+    pt = rng.rand(1000).astype(np.float32)
+    h = rows_multiset_hash([hits, pt], block_size=100)
+    perm = rng.permutation(1000)
+    assert h == rows_multiset_hash([hits[perm], pt[perm]], block_size=333)
+
+    # Duplicated rows, also zero rows, are counted
+    hits[1] = hits[0]
+    pt[1] = pt[0]
+    hits[2:4] = 0
+    pt[2:4] = 0
+    h = rows_multiset_hash([hits, pt])
+    for i, j in [(1, 0), (2, 3)]:
+        other = hits.copy()
+        other[i] = hits[4]
+        assert h != rows_multiset_hash([other, pt]), \
+            "Replaced duplicate row not detected!"
+    assert rows_multiset_hash([hits[:3]]) != rows_multiset_hash([hits[:4]]),\
+        "Zero row not counted!"
+    print('Hash test passed')
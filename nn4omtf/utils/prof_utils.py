@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2018 Jacek Łysiak
+    MIT License
+
+    Stage-level profiling of long running jobs.
+    For each named stage wall time, CPU time, bytes read and written
+    (by read/write system calls, memory-mapped access is not counted)
+    and peak resident memory of process are collected.
+"""
+
+import contextlib
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def io_counters():
+    """
+    Get number of bytes read and written by current process.
+    Returns:
+        (read bytes, written bytes), zeros if not available
+    """
+    try:
+        with open('/proc/self/io') as f:
+            vals = dict([l.split(': ') for l in f.read().splitlines()])
+        return int(vals['rchar']), int(vals['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def peak_rss():
+    """
+    Get peak resident set size of current process in bytes.
+    """
+    if resource is None:
+        return 0
+    # Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageProfiler:
+    """
+    Collect resources used by named stages.
+    Stages can be entered many times, results are accumulated.
+    Results collected in other processes can be merged.
+
+    # Example
+    ```
+        prof = StageProfiler()
+        with prof.stage('load'):
+            data = np.load(path)
+        prof.print_report()
+    ```
+    """
+
+    def __init__(self):
+        self.stages = dict()
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        rd, wr = io_counters()
+        try:
+            yield
+        finally:
+            _rd, _wr = io_counters()
+            self.add(name, wall=time.perf_counter() - wall,
+                    cpu=time.process_time() - cpu, read_bytes=_rd - rd,
+                    write_bytes=_wr - wr, peak_rss=peak_rss())
+
+
+    def add(self, name, wall=0., cpu=0., read_bytes=0, write_bytes=0,
+            peak_rss=0, calls=1):
+        """
+        Add resources used by stage.
+        """
+        s = self.stages.setdefault(name, {'calls': 0, 'wall': 0.,
+            'cpu': 0., 'read_bytes': 0, 'write_bytes': 0, 'peak_rss': 0})
+        s['calls'] += calls
+        s['wall'] += wall
+        s['cpu'] += cpu
+        s['read_bytes'] += read_bytes
+        s['write_bytes'] += write_bytes
+        s['peak_rss'] = max(s['peak_rss'], peak_rss)
+
+
+    def merge(self, stages):
+        """
+        Merge stages collected by other profiler, e.g. in worker process.
+        Args:
+            stages: `StageProfiler.stages` dict
+        """
+        for name, s in stages.items():
+            self.add(name, **s)
+
+
+    def get_report(self):
+        """
+        Returns:
+            dict( stage name: dict of used resources ) and
+            total `peak_rss` of all stages
+        """
+        return {
+            'stages': dict([(k, dict(v)) for k, v in self.stages.items()]),
+            'peak_rss': max([0] + [s['peak_rss']
+                for s in self.stages.values()])}
+
+
+    def print_report(self):
+        print('=' * 10 + ' PROFILE')
+        print("%-12s %6s %10s %10s %10s %10s %10s" % ('stage', 'calls',
+            'wall s', 'cpu s', 'read MB', 'write MB', 'peak MB'))
+        for name, s in self.stages.items():
+            print("%-12s %6d %10.3f %10.3f %10.1f %10.1f %10.1f" % (name,
+                s['calls'], s['wall'], s['cpu'], s['read_bytes'] / 2**20,
+                s['write_bytes'] / 2**20, s['peak_rss'] / 2**20))
@@ -10,6 +10,8 @@ import importlib.util
 import importlib.machinery
 import os
 import inspect
+import queue
+import threading
 
 
 def obj_elems(x):
@@ -55,3 +57,49 @@ def dict_to_object(dictionary):
             self.__dict__ = d
     return Dict2Obj(dictionary)
 
+
+def prefetch_iter(iterable, depth=1):
+    """Iterate in background thread.
+    Next items are produced while current one is processed, at most
+    `depth` items wait in queue. Exceptions are raised in caller thread.
+    Thread stops when returned generator is closed.
+    Args:
+        iterable: iterable to read, e.g. generator doing I/O
+        depth: number of items read ahead
+    Returns:
+        generator of `iterable` items
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for x in iterable:
+                if not put((x, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            x, err = items.get()
+            if x is end:
+                if err is not None:
+                    raise err
+                return
+            yield x
+    finally:
+        stop.set()